@@ -0,0 +1,218 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+# microbenchmarks of the protocol and conversion hot paths, runs without a gui and without a serial port
+#
+#   python benchmarks/Benchmarks.py                   run all benchmarks and compare them with the baseline
+#   python benchmarks/Benchmarks.py --save-baseline   store the results as the new baseline
+#   python benchmarks/Benchmarks.py --filter framer   only run benchmarks with 'framer' in their name
+import os, sys, gc, time, json, random, platform, argparse
+
+BASE_PATH = os.path.abspath(os.path.realpath(os.path.dirname(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(BASE_PATH), 'src'))
+
+from SerialProtocol import SerialProtocol, memoryFields
+from PacketFramer import PacketFramer
+from common.DataConverter import DataConverter
+
+# cpu time of this process where the clock has a fine resolution, so other processes don't slow down the measurements
+timer = time.time if sys.platform == 'win32' else time.clock
+
+def measure(function, minTime=0.1, repeat=7):
+    # returns the median and the best ops/s of several runs, the median is what gets compared, as single runs are
+    # easily slowed down by other processes
+    loops = 1
+    while True:
+        startTime = timer()
+        for _ in xrange(loops):
+            function()
+        if timer() - startTime >= minTime / 10:
+            break
+        loops *= 2
+    loops = max(1, int(loops * minTime / max(timer() - startTime, 1e-9)))
+    rates = []
+    for _ in range(repeat):
+        gc.collect() # start every run with the same garbage collector state
+        startTime = timer()
+        for _ in xrange(loops):
+            function()
+        rates.append(loops / max(timer() - startTime, 1e-9))
+    rates.sort()
+    return rates[len(rates) // 2], rates[-1]
+
+
+def countAllocations(function, calls=1000):
+    # objects allocated per call, None if the interpreter can't count allocations (only builds with COUNT_ALLOCS can)
+    if not hasattr(sys, 'getcounts'):
+        return None
+    def allocationsOf(function):
+        function() # warm up caches
+        allocationsBefore = sum(count[1] for count in sys.getcounts())
+        for _ in xrange(calls):
+            function()
+        return sum(count[1] for count in sys.getcounts()) - allocationsBefore
+    return (allocationsOf(function) - allocationsOf(lambda: None)) / float(calls)
+
+
+def countRetainedObjects(function, calls=1000):
+    # gc tracked objects each call leaves behind: without collections the first gc counter is the number
+    # of allocated minus freed container objects, so this finds leaks and growing caches, not allocations
+    function()
+    gcEnabled = gc.isenabled()
+    gc.collect()
+    gc.disable()
+    try:
+        countBefore = gc.get_count()[0]
+        for _ in xrange(calls):
+            function()
+        return (gc.get_count()[0] - countBefore) / float(calls)
+    finally:
+        if gcEnabled:
+            gc.enable()
+
+
+def makeStream(numPackets, noiseProbability):
+    # valid packets with random payload, with random garbage in between
+    random.seed(42)
+    stream = bytearray()
+    for i in range(numPackets):
+        if random.random() < noiseProbability:
+            stream += bytearray(random.randint(0, 255) for _ in range(random.randint(1, 8)))
+        payload = [random.randint(0, 255) for _ in range(random.randint(0, 8))]
+        packet = [i % 253, 2 + len(payload), 0] + payload
+        stream += bytearray([0xff, 0xff] + packet + [(~sum(packet)) & 0xff])
+    return str(stream)
+
+
+def framerBenchmark(stream, chunkSize):
+    def run():
+        framer = PacketFramer()
+        for position in xrange(0, len(stream), chunkSize):
+            framer.feed(stream[position:position + chunkSize])
+            for _ in framer.packets():
+                pass
+    return run
+
+
+def collectBenchmarks():
+    # list of (name, function, bytes per call)
+    benchmarks = []
+    protocol = SerialProtocol()
+    protocol.setProtocol('RobotisServo')
+    readCode = protocol.instructionCode['READ']
+    writeCode = protocol.instructionCode['WRITE']
+    writeData = [30] + range(100)
+    readPacket = protocol.makePacket(1, readCode, [36, 2])
+    writePacket = protocol.makePacket(1, writeCode, writeData)
+    longData = bytearray(random.Random(1).randint(0, 255) for _ in range(250))
+
+    benchmarks.append(('makePacket READ', lambda: protocol.makePacket(1, readCode, [36, 2]), len(readPacket)))
+    benchmarks.append(('makePacket WRITE 100 bytes', lambda: protocol.makePacket(1, writeCode, writeData), len(writePacket)))
+    benchmarks.append(('makePacket by instruction name', lambda: protocol.makePacket(1, 'READ', [36, 2]), len(readPacket)))
+    benchmarks.append(('parsePacket READ', lambda: protocol.parsePacket(readPacket), len(readPacket)))
+    benchmarks.append(('parsePacket WRITE 100 bytes', lambda: protocol.parsePacket(writePacket), len(writePacket)))
+    benchmarks.append(('calulateChecksum 8 bytes', lambda: protocol.calulateChecksum(readPacket, 2, len(readPacket) - 1), 5))
+    benchmarks.append(('calulateChecksum 250 bytes', lambda: protocol.calulateChecksum(longData), len(longData)))
+
+    for protocolName in sorted(memoryFields.keys()):
+        benchmarks.append(('setProtocol %s' % protocolName, lambda protocolName=protocolName: SerialProtocol().setProtocol(protocolName), 0))
+
+    converter = DataConverter(bigEndian=False)
+    for typeName in sorted(DataConverter.formatCharacter.keys()):
+        value = 1.5 if typeName in ['float', 'double'] or typeName.startswith('fxp') else 42
+        binString = converter.toString(value, typeName)
+        benchmarks.append(('DataConverter.toString %s' % typeName, lambda value=value, typeName=typeName: converter.toString(value, typeName), len(binString)))
+        benchmarks.append(('DataConverter.fromString %s' % typeName, lambda binString=binString, typeName=typeName: converter.fromString(binString, typeName), len(binString)))
+
+    for noiseProbability in [0.0, 0.1]:
+        stream = makeStream(2000, noiseProbability)
+        for chunkSize in [1, 16, 256, 4096]:
+            name = 'framer %4d byte chunks, %d%% noise' % (chunkSize, noiseProbability * 100)
+            benchmarks.append((name, framerBenchmark(stream, chunkSize), len(stream)))
+    return benchmarks
+
+
+def compareToBaseline(opsPerSecond, bestOpsPerSecond, baselineResult):
+    # ratios of the median and of the best run, older baselines only have the median
+    return (opsPerSecond / baselineResult['opsPerSecond'],
+            bestOpsPerSecond / baselineResult.get('bestOpsPerSecond', baselineResult['opsPerSecond']))
+
+
+def main():
+    argumentParser = argparse.ArgumentParser(description='ServoTool microbenchmarks')
+    argumentParser.add_argument('--baseline', default=os.path.join(BASE_PATH, 'baseline.json'), help='baseline file')
+    argumentParser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    argumentParser.add_argument('--filter', default='', help='only run benchmarks containing this text')
+    argumentParser.add_argument('--min-time', type=float, default=0.1, help='[s] minimum time of each measurement')
+    argumentParser.add_argument('--repeat', type=int, default=7, help='measurements of each benchmark, the median is compared')
+    argumentParser.add_argument('--passes', type=int, default=0, help='passes over all benchmarks, the median is kept (default: 1, 3 with --save-baseline)')
+    argumentParser.add_argument('--tolerance', type=float, default=0.2, help='relative slow down which counts as regression')
+    arguments = argumentParser.parse_args()
+
+    baseline = {}
+    if os.path.exists(arguments.baseline):
+        baseline = json.load(open(arguments.baseline))['results']
+
+    results = {}
+    ratios = {}
+    functions = {}
+    if not hasattr(sys, 'getcounts'):
+        print 'this python can\'t count allocations (it needs to be built with COUNT_ALLOCS), only retained objects are shown'
+    benchmarks = [(name, function, numBytes) for name, function, numBytes in collectBenchmarks() if arguments.filter in name]
+    # the speed of single benchmarks drifts over minutes, so a baseline is taken from several passes over all of them
+    passes = arguments.passes or (3 if arguments.save_baseline else 1)
+    measurements = dict((name, []) for name, function, numBytes in benchmarks)
+    for _ in range(passes - 1):
+        for name, function, numBytes in benchmarks:
+            measurements[name].append(measure(function, arguments.min_time, arguments.repeat))
+    print '%-44s %14s %12s %8s %10s %10s' % ('benchmark', 'ops/s', 'MB/s', 'allocs', 'retained', 'baseline')
+    for name, function, numBytes in benchmarks:
+        functions[name] = function
+        measurements[name].append(measure(function, arguments.min_time, arguments.repeat))
+        opsPerSecond = sorted(median for median, best in measurements[name])[passes // 2]
+        bestOpsPerSecond = max(best for median, best in measurements[name])
+        comparison = ''
+        if name in baseline:
+            ratios[name] = compareToBaseline(opsPerSecond, bestOpsPerSecond, baseline[name])
+            comparison = '%9.2fx' % ratios[name][0]
+        calls = max(10, min(1000, int(opsPerSecond * arguments.min_time)))
+        allocations = countAllocations(function, calls)
+        retainedObjects = countRetainedObjects(function, calls)
+        results[name] = {'opsPerSecond': opsPerSecond, 'bestOpsPerSecond': bestOpsPerSecond, 'allocations': allocations, 'retainedObjects': retainedObjects}
+        megabytesPerSecond = '%12.2f' % (opsPerSecond * numBytes / 1e6) if numBytes else '%12s' % '-'
+        allocationsString = '%8.1f' % allocations if allocations is not None else '%8s' % '-'
+        print '%-44s %14.0f %s %s %10.2f %s' % (name, opsPerSecond, megabytesPerSecond, allocationsString, retainedObjects, comparison)
+
+    # the whole machine may be slower than when the baseline was taken, so with enough benchmarks to tell, a regression
+    # has to be slower than the baseline and than the typical ratio of this run, a faster run does not raise the limit
+    medianRatios = sorted(ratio for ratio, bestRatio in ratios.values())
+    machineRatio = min(1.0, medianRatios[len(medianRatios) // 2]) if len(medianRatios) >= 5 else 1.0
+    limit = (1 - arguments.tolerance) * machineRatio
+    regressions = []
+    for name in sorted(ratios.keys()):
+        if max(ratios[name]) < limit:
+            # noise only ever slows down, and comes in bursts, so measure once more now that the other benchmarks ran in
+            # between and keep the faster series
+            opsPerSecond, bestOpsPerSecond = measure(functions[name], arguments.min_time, arguments.repeat)
+            results[name]['opsPerSecond'] = max(results[name]['opsPerSecond'], opsPerSecond)
+            results[name]['bestOpsPerSecond'] = max(results[name]['bestOpsPerSecond'], bestOpsPerSecond)
+            ratios[name] = compareToBaseline(results[name]['opsPerSecond'], results[name]['bestOpsPerSecond'], baseline[name])
+            if max(ratios[name]) < limit:
+                regressions.append(name)
+    for name in regressions:
+        print 'SLOWER: %s at %.2fx (best %.2fx) of the baseline, the median of all benchmarks is %.2fx' % ((name,) + ratios[name] + (machineRatio,))
+
+    if arguments.save_baseline:
+        if arguments.filter:
+            baseline.update(results) # keep the results of the benchmarks which did not run
+            results = baseline
+        baselineFile = open(arguments.baseline, 'w')
+        json.dump({'python': platform.python_version(), 'platform': platform.platform(), 'results': results}, baselineFile, indent=2, sort_keys=True)
+        baselineFile.close()
+        print 'baseline saved to %s' % arguments.baseline
+    elif regressions:
+        print '%d benchmarks are more than %d%% slower than the baseline and the rest of this run, in the median and the best run' % (len(regressions), arguments.tolerance * 100)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+import os, struct, bisect
+
+# capture files start with a magic string, followed by records of a header (timestamp, direction, length) and the raw bytes,
+# a separate index file holds (timestamp, file offset) pairs written every indexInterval seconds for seeking
+captureMagic = 'SRVCAP01'
+recordHeader = struct.Struct('<dBI')
+indexEntry = struct.Struct('<dQ')
+
+RECEIVED = 0
+SENT = 1
+
+class BusRecorder:
+    # appends every chunk of raw bytes read from or written to the bus to a capture file
+
+    def __init__(self, fileName, indexInterval=1.0):
+        self.fileName = fileName
+        self.indexInterval = indexInterval
+        self.captureFile = open(fileName, 'wb')
+        self.captureFile.write(captureMagic)
+        self.indexFile = open(fileName + '.idx', 'wb')
+        self.lastIndexTime = None
+        self.numRecords = 0
+        self.numBytes = 0
+
+    def record(self, timestamp, direction, data):
+        if self.lastIndexTime is None or timestamp - self.lastIndexTime >= self.indexInterval:
+            # the index entry is written before the record, so it never points behind the end of the capture file
+            self.captureFile.flush()
+            self.indexFile.write(indexEntry.pack(timestamp, self.captureFile.tell()))
+            self.indexFile.flush()
+            self.lastIndexTime = timestamp
+        self.captureFile.write(recordHeader.pack(timestamp, direction, len(data)))
+        self.captureFile.write(str(data))
+        self.numRecords += 1
+        self.numBytes += len(data)
+
+    def close(self):
+        self.captureFile.close()
+        self.indexFile.close()
+
+
+class BusCapture:
+    # reads a capture file, using the index file (if there is one) to start at a given time
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.captureFile = open(fileName, 'rb')
+        if self.captureFile.read(len(captureMagic)) != captureMagic:
+            raise IOError('%s is not a bus capture file' % fileName)
+        self.indexTimes = []
+        self.indexOffsets = []
+        if os.path.exists(fileName + '.idx'):
+            indexData = open(fileName + '.idx', 'rb').read()
+            for position in range(0, len(indexData) - indexEntry.size + 1, indexEntry.size):
+                timestamp, offset = indexEntry.unpack_from(indexData, position)
+                self.indexTimes.append(timestamp)
+                self.indexOffsets.append(offset)
+
+    def seek(self, timestamp):
+        # continue reading at the last indexed record before timestamp
+        position = bisect.bisect_right(self.indexTimes, timestamp) - 1
+        if position < 0:
+            self.captureFile.seek(len(captureMagic))
+        else:
+            self.captureFile.seek(self.indexOffsets[position])
+
+    def records(self, startTime=None):
+        # generator of (timestamp, direction, data) tuples, a truncated last record is ignored
+        if startTime is None:
+            self.captureFile.seek(len(captureMagic))
+        else:
+            self.seek(startTime)
+        while True:
+            header = self.captureFile.read(recordHeader.size)
+            if len(header) < recordHeader.size:
+                return
+            timestamp, direction, length = recordHeader.unpack(header)
+            data = self.captureFile.read(length)
+            if len(data) < length:
+                return
+            if startTime is None or timestamp >= startTime:
+                yield timestamp, direction, data
+
+    def close(self):
+        self.captureFile.close()
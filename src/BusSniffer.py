@@ -0,0 +1,143 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+from collections import deque
+
+from PacketFramer import PacketFramer
+
+class BusSniffer:
+    # passive decoding of a bus driven by another controller: splits the received bytes into packets and tells requests
+    # from answers by the servo id, the answer length a request asks for and the time the answer has to come in
+    answerTimeout = 0.02 # [s] return delay time of the servos plus the jitter of the usb serial adapter
+    sentRequestTimeout = 0.1 # [s] our own requests wait this long for their answers, like the serial thread does
+    statisticsWindow = 1.0 # [s] the rates are averaged over this time
+
+    def __init__(self, protocol, baudrate):
+        self.protocol = protocol # a SerialProtocol with the protocol of the bus
+        self.baudrate = baudrate
+        self.byteTime = 10.0 / baudrate # start bit, 8 data bits and stop bit
+        self.framer = PacketFramer()
+        self.expectedAnswers = deque()
+        self.receivedChunks = deque() # (timestamp, number of packets, number of bytes) within the statistics window
+        self.counters = {
+            'packets': 0,
+            'bytes': 0,
+            'requests': 0,
+            'answers': 0,
+            'unanswered': 0,
+            'checksumErrors': 0,
+            'discardedBytes': 0,
+        }
+
+    def feed(self, timestamp, data):
+        # returns (timestamp, servo id, instruction or error code, packet data, checksum ok, request) of all complete packets,
+        # request is None for requests and the request being answered for answers
+        self.framer.feed(data)
+        packets = []
+        for packet in self.framer.packets():
+            # the packet ended before the bytes which are still buffered behind it were received
+            packetTime = timestamp - self.framer.bufferedBytes() * self.byteTime
+            packets.append(self.evaluatePacket(packetTime, bytearray(packet)))
+        self.counters['packets'] += len(packets)
+        self.counters['bytes'] += len(data)
+        self.counters['discardedBytes'] += self.framer.discardedBytes
+        self.framer.discardedBytes = 0
+        self.receivedChunks.append((timestamp, len(packets), len(data)))
+        return packets
+
+    def evaluatePacket(self, packetTime, packetBytes, sent=None):
+        # sent is None for a bus we only listen to, where requests and answers are told apart by timing, for recorded
+        # traffic of our own controller it tells whether the packet was sent (a request) or received (an answer),
+        # an answer which matches no request is returned with a request without instruction name
+        servoId, instruction, packetData, packetChecksum, realChecksum = self.protocol.parsePacket(packetBytes)
+        checksumOk = packetChecksum == realChecksum
+        if not checksumOk:
+            self.counters['checksumErrors'] += 1
+
+        while self.expectedAnswers and self.expectedAnswers[0]['deadline'] < packetTime:
+            self.counters['unanswered'] += not self.expectedAnswers.popleft().get('answered')
+
+        expected = None
+        if sent is None:
+            if self.expectedAnswers and self.expectedAnswers[0]['servoId'] in [servoId, None]:
+                expected = self.expectedAnswers[0]
+                if checksumOk and expected['dataLength'] is not None and expected['dataLength'] != len(packetData):
+                    expected = None
+        elif not sent:
+            # several of our requests may wait for their answers at the same time
+            expected = self.matchAnswer(servoId)
+            if expected is None:
+                return (packetTime, servoId, instruction, packetData, checksumOk, {'servoId': servoId, 'instructionName': None, 'address': None})
+
+        if expected is not None:
+            if expected['servoId'] is None:
+                # any servo may answer a broadcast ping, the next answer can follow this one
+                expected['deadline'] = packetTime + expected['timeout'] + 6 * self.byteTime
+                expected['answered'] = True
+            else:
+                self.expectedAnswers.remove(expected)
+            self.counters['answers'] += 1
+            return (packetTime, servoId, instruction, packetData, checksumOk, expected)
+
+        if sent is None:
+            # anything else is a new request, so the answers to the previous one won't come anymore
+            self.counters['unanswered'] += len([expected for expected in self.expectedAnswers if not expected.get('answered')])
+            self.expectedAnswers.clear()
+        self.counters['requests'] += 1
+        request = self.makeRequest(servoId, self.protocol.getInstructionName(instruction), packetData)
+        if checksumOk:
+            self.expectAnswers(packetTime, request, self.answerTimeout if sent is None else self.sentRequestTimeout)
+        return (packetTime, servoId, instruction, packetData, checksumOk, None)
+
+    def matchAnswer(self, servoId):
+        # the oldest answer expected from this servo, or a broadcast ping which any servo may answer
+        broadcastPing = None
+        for expected in self.expectedAnswers:
+            if expected['servoId'] == servoId:
+                return expected
+            if broadcastPing is None and expected['servoId'] is None:
+                broadcastPing = expected
+        return broadcastPing
+
+    def makeRequest(self, servoId, instructionName, packetData):
+        request = {'servoId': servoId, 'instructionName': instructionName, 'address': None, 'length': None, 'data': packetData}
+        if instructionName in ['READ', 'WRITE', 'REG_WRITE', self.protocol.syncReadInstruction] and len(packetData) > 0:
+            request['address'] = packetData[0]
+            if instructionName in ['WRITE', 'REG_WRITE']:
+                request['length'] = len(packetData) - 1
+            elif len(packetData) > 1:
+                request['length'] = packetData[1]
+        return request
+
+    def expectAnswers(self, packetTime, request, timeout):
+        servoId = request['servoId']
+        instructionName = request['instructionName']
+        if instructionName == self.protocol.syncReadInstruction and request['length'] is not None:
+            # the listed servos answer one after the other
+            servoIdList = [answerId for answerId in request['data'][2:] if answerId != self.protocol.broadcastId]
+            answers = [{'servoId': answerId, 'instructionName': 'READ', 'address': request['address'], 'dataLength': request['length']} for answerId in servoIdList]
+        elif servoId == self.protocol.broadcastId and instructionName == 'PING':
+            # all servos answer one after the other, so answers from any id are taken until none came for a while
+            answers = [dict(request, servoId=None, dataLength=0)]
+        elif servoId == self.protocol.broadcastId:
+            return # other broadcasts are not answered
+        elif instructionName == 'READ':
+            answers = [dict(request, dataLength=request['length'])]
+        else:
+            answers = [dict(request, dataLength=0)]
+        deadline = packetTime + timeout
+        for answer in answers:
+            # an answer has 6 bytes plus its data
+            deadline += (6 + (answer['dataLength'] or 0)) * self.byteTime
+            answer['deadline'] = deadline
+            answer['timeout'] = timeout
+            self.expectedAnswers.append(answer)
+
+    def statistics(self, now):
+        # counters since the start and rates within the last statisticsWindow seconds
+        while self.receivedChunks and self.receivedChunks[0][0] < now - self.statisticsWindow:
+            self.receivedChunks.popleft()
+        statistics = dict(self.counters)
+        statistics['packetsPerSecond'] = sum(chunk[1] for chunk in self.receivedChunks) / self.statisticsWindow
+        statistics['bytesPerSecond'] = sum(chunk[2] for chunk in self.receivedChunks) / self.statisticsWindow
+        statistics['busUtilization'] = 100.0 * statistics['bytesPerSecond'] * self.byteTime
+        return statistics
@@ -0,0 +1,62 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+import numpy
+
+class FleetMemory:
+    # memory of all servos as one numpy record array with a row per servo, e.g. to query
+    # fleetMemory.select(fleetMemory.field('PresentTemperature') > 60)
+
+    def __init__(self, dtype, memoryInfo, capacity=32):
+        self.dtype = dtype
+        self.memoryInfo = memoryInfo
+        self.servoIds = []
+        self.rows = {}
+        self.allocate(capacity)
+
+    def allocate(self, capacity):
+        records = numpy.zeros(capacity, self.dtype)
+        if self.servoIds:
+            records[:len(self.servoIds)] = self.records[:len(self.servoIds)]
+        self.records = records
+        self.recordBytes = records.view(numpy.uint8).reshape(capacity, self.dtype.itemsize)
+
+    def row(self, servoId):
+        if servoId not in self.rows:
+            if len(self.servoIds) == len(self.records):
+                self.allocate(2 * len(self.records))
+            self.rows[servoId] = len(self.servoIds)
+            self.servoIds.append(servoId)
+        return self.rows[servoId]
+
+    def update(self, servoId, memoryAddress, data):
+        # copy the reply data into the row of the servo without decoding it
+        row = self.row(servoId)
+        self.recordBytes[row, memoryAddress:memoryAddress + len(data)] = numpy.frombuffer(buffer(data), numpy.uint8)
+
+    def remove(self, servoIdList=None):
+        if servoIdList is None:
+            servoIdList = list(self.servoIds)
+        for servoId in servoIdList:
+            if servoId in self.rows:
+                # move the last row into the gap
+                row = self.rows.pop(servoId)
+                lastServoId = self.servoIds.pop()
+                if lastServoId != servoId:
+                    self.records[row] = self.records[len(self.servoIds)]
+                    self.servoIds[row] = lastServoId
+                    self.rows[lastServoId] = row
+
+    def fleet(self):
+        # record array of all known servos, in the order of self.servoIds
+        return self.records[:len(self.servoIds)]
+
+    def field(self, fieldName):
+        # values of one field of all servos, fixed point fields scaled to float
+        values = self.fleet()[fieldName]
+        scale = self.memoryInfo[fieldName]['scale']
+        if scale:
+            values = values * scale
+        return values
+
+    def select(self, mask):
+        return [self.servoIds[row] for row in numpy.flatnonzero(mask)]
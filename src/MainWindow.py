@@ -6,12 +6,14 @@ SCRIPT_PATH = os.path.dirname(os.path.realpath(__file__))
 BASE_PATH = os.path.abspath(os.path.join(SCRIPT_PATH, '..'))
 
 from PyQt4 import uic
-from PyQt4.QtGui import QMainWindow, QTableWidgetItem, QMenu, QIcon
+from PyQt4.QtGui import QMainWindow, QTableWidgetItem, QMenu, QIcon, QMessageBox
 from PyQt4.QtCore import QByteArray, QSettings, QSize, QTimer, Qt, QPoint, QVariant, pyqtSignal as Signal, pyqtSlot as Slot
 
+from SerialProtocol import SerialProtocol
 from common.LogView import LogView
 from common.Configuration import Configuration
 from common.DataConverter import DataConverter
+from common.StatisticsPanel import StatisticsPanel
 
 (MainWindowClass, MainWindowBaseClass) = uic.loadUiType(os.path.join(BASE_PATH, 'res', 'MainWindow.ui'))
 
@@ -22,8 +24,12 @@ class MainWindow(QMainWindow, MainWindowClass):
     serialConnectionPing = Signal(list)
     serialConnectionScan = Signal()
     serialConnectionScanSlow = Signal()
+    serialConnectionFindBaudrate = Signal(list, bool)
+    serialConnectionOptimizeBusSpeed = Signal(list, int, int)
     serialConnectionReadAllData = Signal(list)
+    serialConnectionRefreshData = Signal(list)
     serialConnectionReadData = Signal(list, int, int)
+    serialConnectionSyncReadData = Signal(list, int, int)
     serialConnectionWriteData = Signal(list, int, list)
     serialConnectionSendData = Signal(list)
     serialConnectionSendCustomPacket = Signal(int, str, list)
@@ -33,6 +39,7 @@ class MainWindow(QMainWindow, MainWindowClass):
 
         # setup member variables
         self.serialProtocol = serialProtocol
+        self.protocol = SerialProtocol() # own copy for the table layout and decoding, the one of the serial thread is only used by it
         self.servos = {}
         self.columns = {}
         self.updating = False
@@ -44,7 +51,9 @@ class MainWindow(QMainWindow, MainWindowClass):
         self.setupUi(self)
         self.buttonDataLog.setVisible(False)
         self.setWindowIcon(QIcon(os.path.join(BASE_PATH, 'res', 'SerialTool.png')))
-        self.comboProtocolName.addItems(self.serialProtocol.availableProtocolNames)
+        self.comboProtocolName.addItems(self.protocol.availableProtocolNames)
+        self.statisticsPanel = StatisticsPanel(self)
+        self.addDockWidget(Qt.BottomDockWidgetArea, self.statisticsPanel)
         self.restoreGuiSettings()
 
         # open configuration file
@@ -59,6 +68,7 @@ class MainWindow(QMainWindow, MainWindowClass):
 
         # init log view
         self.logView = LogView(self, self.textLogView)
+        self.logView.setLogFile(self.configuration.get('logFileName', None))
         self.spinLogLevel.valueChanged.connect(self.logView.logLevelChanged)
         self.logView.logLevelChanged.emit(self.spinLogLevel.value()) # emit signal manually to set initial value
 
@@ -67,6 +77,9 @@ class MainWindow(QMainWindow, MainWindowClass):
         self.buttonDataPlotClear.clicked.connect(self.dataPlotClear)
         self.buttonDataPlotPause.toggled.connect(self.dataPlotTogglePause)
         self.buttonDataPlotOsciMode.toggled.connect(self.dataPlot.toggleOscilloscopeMode)
+        plotHistoryDirectory = self.configuration.get('plotHistoryDirectory', None)
+        if plotHistoryDirectory:
+            self.dataPlot.enableHistory(plotHistoryDirectory)
 
         self.subscribedData = {}
         self.initTable()
@@ -80,10 +93,10 @@ class MainWindow(QMainWindow, MainWindowClass):
         self.tableServoData.clear()
         self.tableServoData.setColumnCount(1)
         self.tableServoData.setHorizontalHeaderItem(0, QTableWidgetItem('Parameter'))
-        self.tableServoData.setRowCount(len(self.serialProtocol.memoryInfo['fieldNames']))
+        self.tableServoData.setRowCount(len(self.protocol.memoryInfo['fieldNames']))
         rowNumber = 0
-        for fieldName in self.serialProtocol.memoryInfo['fieldNames']:
-            fieldInfo = self.serialProtocol.memoryInfo[fieldName]
+        for fieldName in self.protocol.memoryInfo['fieldNames']:
+            fieldInfo = self.protocol.memoryInfo[fieldName]
             nameItem = QTableWidgetItem(fieldInfo['name'])
             if fieldInfo['writable']:
                 nameItem.setFlags(Qt.ItemIsEnabled | Qt.ItemIsSelectable)
@@ -102,6 +115,8 @@ class MainWindow(QMainWindow, MainWindowClass):
     def closeEvent(self, event):
         self.saveGuiSettings()
         self.storeData()
+        self.dataPlot.closeHistory()
+        self.logView.close()
 
 
     def storeData(self):
@@ -188,6 +203,31 @@ class MainWindow(QMainWindow, MainWindowClass):
         self.logView.logMessage.emit(level, message)
 
 
+    def busStatisticsUpdate(self, statistics):
+        self.statusBar().showMessage('%(packetsPerSecond)d packets/s, %(bytesPerSecond)d bytes/s, %(busUtilization).1f %% bus load, '
+            '%(unanswered)d unanswered, %(checksumErrors)d checksum errors, %(discardedBytes)d bytes discarded' % statistics)
+
+
+    def baudrateFound(self, baudrate, servoIdList):
+        self.log(1, 'Servos %s answer at %d baud' % (', '.join(map(str, servoIdList)), baudrate))
+
+
+    def baudrateChanged(self, baudrate):
+        if self.comboSerialBaudrate.findText(str(baudrate)) < 0:
+            self.comboSerialBaudrate.addItem(str(baudrate))
+        self.comboSerialBaudrate.setCurrentIndex(self.comboSerialBaudrate.findText(str(baudrate)))
+
+
+    def busSpeedOptimized(self, result):
+        if result['failedIds']:
+            self.log(0, 'Bus speed optimization failed and servo ids %s could not be restored, use Find Baud to locate them' % ', '.join(map(str, result['failedIds'])))
+        elif result['rolledBack']:
+            self.log(0, 'Bus speed optimization failed, the servos are back at their old settings at %d baud' % result['baudrate'])
+        else:
+            self.log(1, 'Poll rate at %d baud: %.0f reads/s (before %.0f reads/s, %.1f times faster)' % (result['baudrate'],
+                result['pollRateAfter'], result['pollRateBefore'], result['pollRateAfter'] / result['pollRateBefore']))
+
+
     def packetSent(self, packetBytes):
         # clear received data field, so unanswered packets don't show the last received packet
         self.textDataReceived.clear()
@@ -238,26 +278,22 @@ class MainWindow(QMainWindow, MainWindowClass):
         self.labelNumServosFound.setText('%d found' % len(self.servos))
 
 
-    def servoDataUpdate(self, servoId, addressOffset, servoData):
+    def servoDataBatchUpdate(self, servoDataBatch):
+        for servoId, addressOffset, servoData, timestamp in servoDataBatch:
+            self.servoDataUpdate(servoId, addressOffset, servoData, timestamp)
+
+
+    def servoDataUpdate(self, servoId, addressOffset, servoData, timestamp=None):
         if not self.servos.has_key(servoId):
             self.servoAdd(servoId)
         columnNumber = self.servos[servoId]['columnNumber']
         self.updating = True
-        servoDataString = ('%c' * len(servoData)) % tuple(chr(c) for c in servoData)
-        index = 0
-        while index < len(servoDataString):
-            fieldInfo = self.serialProtocol.memoryInfo[addressOffset + index]
-
-            if fieldInfo['numElements'] != 1:
-                self.log(0, 'ERROR: MainWindow.servoDataUpdate(): numElements != 1 -> Arrays are not supported, yet...')
-
-            value = self.converter.fromString(servoDataString[index:], fieldInfo['type'])
-            index += fieldInfo['size']
+        for fieldInfo, value in self.protocol.decodeMemory(addressOffset, servoData):
 
             # check if the item is being plotted
             subscribeId = '[%d].%s' % (servoId, fieldInfo['name'])
-            if self.subscribedData.has_key(subscribeId):
-                self.dataPlot.updateValue(subscribeId, float(value))
+            if self.subscribedData.has_key(subscribeId) and fieldInfo['numElements'] == 1:
+                self.dataPlot.updateValue(subscribeId, float(value), timestamp)
 
             # check for existing item, or create a new one
             dataItem = self.tableServoData.item(fieldInfo['index'], columnNumber)
@@ -287,9 +323,10 @@ class MainWindow(QMainWindow, MainWindowClass):
 
     @Slot(str)
     def on_comboProtocolName_currentIndexChanged(self, text):
-        self.serialProtocol.setProtocol(str(text))
+        self.protocol.setProtocol(str(text))
+        self.serialProtocol.setProtocol(str(text)) # queued, the serial thread switches once it is done with the old protocol
         self.comboCustomCommand.clear()
-        self.comboCustomCommand.addItems(self.serialProtocol.instructionName.values())
+        self.comboCustomCommand.addItems(self.protocol.instructionName.values())
         servoIdList = self.servos.keys()
         self.servos = {}
         self.columns = {}
@@ -303,6 +340,8 @@ class MainWindow(QMainWindow, MainWindowClass):
         self.buttonServoReadAll.setEnabled(enable)
         self.buttonServoRead.setEnabled(enable)
         self.buttonServoPing.setEnabled(enable)
+        self.buttonServoFindBaudrate.setEnabled(enable)
+        self.buttonServoOptimizeBaudrate.setEnabled(enable)
         self.buttonCustomPacketSend.setEnabled(enable)
 
 
@@ -349,6 +388,34 @@ class MainWindow(QMainWindow, MainWindowClass):
         self.tableServoData.setColumnCount(1)
         self.serialConnectionScanSlow.emit()
 
+    @Slot()
+    def on_buttonServoFindBaudrate_clicked(self):
+        if not self.buttonSerialConnect.isChecked():
+            self.buttonSerialConnect.click()
+        self.servos = {}
+        self.columns = {}
+        self.tableServoData.setColumnCount(1)
+        self.comboServoId.clear()
+        baudrateList = [int(self.comboSerialBaudrate.itemText(i)) for i in range(self.comboSerialBaudrate.count())]
+        # trying every baud rate divisor takes a few seconds longer
+        self.serialConnectionFindBaudrate.emit(baudrateList, self.configuration.get('findAllBaudrateDivisors', False))
+
+    @Slot()
+    def on_buttonServoOptimizeBaudrate_clicked(self):
+        if not self.servos:
+            self.log(0, 'Please scan for servos first.')
+            return
+        baudrateList = [int(self.comboSerialBaudrate.itemText(i)) for i in range(self.comboSerialBaudrate.count())]
+        baudrate = self.configuration.get('optimizeBaudrate', max(baudrateList))
+        returnDelayTime = self.configuration.get('optimizeReturnDelayTime', 0)
+        servoIdList = sorted(self.servos.keys())
+        answer = QMessageBox.question(self, 'Optimize bus speed',
+            'Change the baud rate of servo ids %s to %d and their return delay time to %d?\n'
+            'The old settings are restored if any servo fails at the new ones.' % (', '.join(map(str, servoIdList)), baudrate, returnDelayTime),
+            QMessageBox.Ok | QMessageBox.Cancel)
+        if answer == QMessageBox.Ok:
+            self.serialConnectionOptimizeBusSpeed.emit(servoIdList, baudrate, returnDelayTime)
+
     @Slot()
     def on_buttonServoReadAll_clicked(self):
         if not self.servos:
@@ -373,7 +440,7 @@ class MainWindow(QMainWindow, MainWindowClass):
             self.buttonSerialConnect.click()
         servoId = self.getServoIdFrom_comboServoId()
         if servoId is not None:
-            self.serialConnectionReadAllData.emit([servoId])
+            self.serialConnectionRefreshData.emit([servoId]) # bypasses the cache, in case the eeprom got changed elsewhere
 
     @Slot()
     def on_buttonServoPing_clicked(self):
@@ -387,7 +454,7 @@ class MainWindow(QMainWindow, MainWindowClass):
     def on_comboCustomCommand_currentIndexChanged(self, text):
         command = str(text).strip()
         toolTip = 'Packet data in hex (i.e. 0a ff 1e)\nParameters: '
-        toolTip += self.serialProtocol.instructionDescription.get(command, '[no description available]')
+        toolTip += self.protocol.instructionDescription.get(command, '[no description available]')
         self.comboCustomData.setToolTip(toolTip)
 
     @Slot()
@@ -423,22 +490,32 @@ class MainWindow(QMainWindow, MainWindowClass):
     @Slot(int, int)
     def on_tableServoData_cellClicked(self, row, column):
         if column >= 0:
-            fieldName = self.serialProtocol.memoryInfo['fieldNames'][row]
-            fieldInfo = self.serialProtocol.memoryInfo[fieldName]
+            fieldName = self.protocol.memoryInfo['fieldNames'][row]
             if column == 0:
                 servoIdList = self.servos.keys()
                 if len(servoIdList) == 0:
                     return
             else:
                 servoIdList = [self.columns[column]['id']]
-            self.log(3, 'reading from servo id(s) %s: %s [%d]: %d bytes' % (servoIdList, fieldName, fieldInfo['address'], fieldInfo['size']))
-            self.serialConnectionReadData.emit(servoIdList, fieldInfo['address'], fieldInfo['size'])
+            # read the other selected cells, too, so neighbouring fields are merged into the same read
+            fieldRequests = set((servoId, fieldName) for servoId in servoIdList)
+            for item in self.tableServoData.selectedItems():
+                if item.column() > 0 and item.column() in self.columns:
+                    fieldRequests.add((self.columns[item.column()]['id'], self.protocol.memoryInfo['fieldNames'][item.row()]))
+            self.requestData(fieldRequests, 3)
+
+    def requestData(self, fieldRequests, logLevel=8):
+        # read a set of (servo id, field name) pairs with as few requests as possible
+        readPlan = self.protocol.planReads(fieldRequests)
+        for (address, length), servoIdList in self.protocol.groupReads(readPlan).items():
+            self.log(logLevel, 'reading from servo id(s) %s: [%d]: %d bytes' % (servoIdList, address, length))
+            self.serialConnectionSyncReadData.emit(servoIdList, address, length)
 
     # subscribe to regular updates of cell data or the whole row when selecting the first column
     def handleAddToDataPlot(self, item):
         if item and item.column() >= 0:
-            fieldName = self.serialProtocol.memoryInfo['fieldNames'][item.row()]
-            fieldInfo = self.serialProtocol.memoryInfo[fieldName]
+            fieldName = self.protocol.memoryInfo['fieldNames'][item.row()]
+            fieldInfo = self.protocol.memoryInfo[fieldName]
             if item.column() == 0:
                 servoIdList = self.servos.keys()
             else:
@@ -448,6 +525,7 @@ class MainWindow(QMainWindow, MainWindowClass):
                 subscribeId = '[%d].%s' % (servoId, fieldName)
                 self.subscribedData[subscribeId] = {
                     'servoId': servoId,
+                    'fieldName': fieldName,
                     'address': fieldInfo['address'],
                     'size': fieldInfo['size']
                 }
@@ -457,9 +535,10 @@ class MainWindow(QMainWindow, MainWindowClass):
     def timerDataRequest_timeout(self):
         if self.listenOnly:
             return
-        for dataRequest in self.subscribedData.values():
-            self.log(8, 'requesting: %s' % (dataRequest))
-            self.serialConnectionReadData.emit([dataRequest['servoId']], dataRequest['address'], dataRequest['size'])
+        # skip this update if the serial thread has not finished the previous one, yet
+        if self.serialProtocol.pendingCommands() > 0:
+            return
+        self.requestData([(dataRequest['servoId'], dataRequest['fieldName']) for dataRequest in self.subscribedData.values()])
 
     @Slot(int)
     def dataPlotIntervalChanged(self, interval):
@@ -488,8 +567,8 @@ class MainWindow(QMainWindow, MainWindowClass):
         if item and item.column() > 0:
             servoId = self.columns[item.column()]['id']
             value = eval(str(item.text()))
-            fieldName = self.serialProtocol.memoryInfo['fieldNames'][item.row()]
-            fieldInfo = self.serialProtocol.memoryInfo[fieldName]
+            fieldName = self.protocol.memoryInfo['fieldNames'][item.row()]
+            fieldInfo = self.protocol.memoryInfo[fieldName]
             memoryDataList = list(self.converter.toString(value, fieldInfo['type']))
             if fieldName == 'servoId' and value in self.servos:
                 self.log(0, 'Error: trying to set a duplicate servo id: %d' % (value))
@@ -524,10 +603,27 @@ class MainWindow(QMainWindow, MainWindowClass):
             srcRow = srcItem.row()
             srcCol = srcItem.column()
             self.log(1, 'copying to all servos: %d, %d: %s' % (srcRow, srcCol, srcText))
+            if self.listenOnly:
+                self.log(0, 'Can not send data in "listenOnly" mode!')
+                return
+            fieldName = self.protocol.memoryInfo['fieldNames'][srcRow]
+            fieldInfo = self.protocol.memoryInfo[fieldName]
+            if fieldName == 'servoId':
+                self.log(0, 'Error: trying to set a duplicate servo id: %s' % (srcText))
+                return
+            servoIdList = []
+            self.updating = True # don't send each changed cell on its own
             for destCol in range(1, self.tableServoData.columnCount()):
                 if destCol != srcCol:
                     destItem = self.tableServoData.item(srcRow, destCol)
                     if destItem:
                         destItem.setText(srcText)
-
-
+                        servoIdList.append(self.columns[destCol]['id'])
+            self.updating = False
+            if servoIdList:
+                # write all servos at once, so the serial thread can merge them into one sync write packet
+                value = eval(str(srcText))
+                memoryDataList = list(self.converter.toString(value, fieldInfo['type']))
+                self.serialConnectionWriteData.emit(servoIdList, fieldInfo['address'], memoryDataList)
+                # read the values back with one synchronized read, too
+                self.requestData([(servoId, fieldName) for servoId in servoIdList], 3)
@@ -0,0 +1,133 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+class PacketFramer:
+    packetHeader = '\xff\xff'
+    invalidServoId = 0xff
+    minPacketLength = 2 # the length byte counts instruction/error and checksum
+
+    def __init__(self, bufferSize=4096):
+        self.buffer = bytearray(bufferSize)
+        self.start = 0 # first unconsumed byte
+        self.end = 0 # one behind the last received byte
+        self.discardedBytes = 0
+
+    def reset(self):
+        self.start = 0
+        self.end = 0
+
+    def bufferedBytes(self):
+        return self.end - self.start
+
+    def feed(self, data):
+        # append received bytes, reusing the buffer space in front of the first unconsumed byte
+        dataLength = len(data)
+        if dataLength == 0:
+            return
+        if self.end + dataLength > len(self.buffer):
+            pending = self.end - self.start
+            if pending + dataLength > len(self.buffer):
+                # buffer is too small even after compacting, so grow it (no frame views must be held here)
+                self.buffer = self.buffer[self.start:self.end] + bytearray(max(len(self.buffer), dataLength))
+            else:
+                self.buffer[0:pending] = self.buffer[self.start:self.end]
+            self.start = 0
+            self.end = pending
+        self.buffer[self.end:self.end + dataLength] = data
+        self.end += dataLength
+
+    def nextPacket(self):
+        # returns the next complete packet as a memoryview into the buffer, or None if more bytes are needed
+        # the view is only valid until the next call of feed()
+        buffer = self.buffer
+        while True:
+            headerIndex = buffer.find(self.packetHeader, self.start, self.end)
+            if headerIndex < 0:
+                # keep a trailing 0xff, it might be the first half of the next header
+                keep = 1 if self.end > self.start and buffer[self.end - 1] == 0xff else 0
+                self.discardedBytes += self.end - self.start - keep
+                self.start = self.end - keep
+                return None
+            self.discardedBytes += headerIndex - self.start
+            self.start = headerIndex
+
+            if self.end - self.start < 4:
+                return None
+            if buffer[self.start + 2] == self.invalidServoId: # id can't be 0xff
+                self.discardedBytes += 1
+                self.start += 1
+                continue
+            if buffer[self.start + 3] < self.minPacketLength: # length can't be smaler than 2
+                self.discardedBytes += 1
+                self.start += 1
+                continue
+
+            packetEnd = self.start + 4 + buffer[self.start + 3]
+            if packetEnd > self.end: # only if we have the full packet
+                return None
+            packet = memoryview(buffer)[self.start:packetEnd]
+            self.start = packetEnd
+            return packet
+
+    def packets(self):
+        packet = self.nextPacket()
+        while packet is not None:
+            yield packet
+            packet = self.nextPacket()
+
+
+if __name__ == '__main__':
+    # compare the throughput of the framer with the former byte wise receive loop
+    import random, time
+
+    def makeStream(numPackets, noiseProbability):
+        random.seed(42)
+        stream = bytearray()
+        for i in range(numPackets):
+            if random.random() < noiseProbability:
+                stream += bytearray(random.randint(0, 255) for _ in range(random.randint(1, 8)))
+            payload = [random.randint(0, 255) for _ in range(random.randint(0, 8))]
+            packet = [i % 253, 2 + len(payload), 0] + payload
+            stream += bytearray([0xff, 0xff] + packet + [(~sum(packet)) & 0xff])
+        return str(stream)
+
+    def byteWiseLoop(stream):
+        # the algorithm SerialThread.receivePacket used before, reading one byte per call
+        numPackets = 0
+        position = 0
+        receivedBytes = []
+        while position < len(stream):
+            char = stream[position:position + 1]
+            position += 1
+            receivedBytes.append(ord(char))
+            while len(receivedBytes) >= 2 and receivedBytes[:2] != [0xff, 0xff]:
+                receivedBytes.pop(0)
+            if len(receivedBytes) == 3 and receivedBytes[2] == 0xff:
+                receivedBytes.pop(0)
+            elif len(receivedBytes) >= 4 and receivedBytes[3] < 2:
+                receivedBytes.pop(0)
+            elif len(receivedBytes) >= 6 and len(receivedBytes) == 4 + receivedBytes[3]:
+                numPackets += 1
+                receivedBytes = []
+        return numPackets
+
+    def framerLoop(stream, chunkSize):
+        numPackets = 0
+        framer = PacketFramer()
+        for position in range(0, len(stream), chunkSize):
+            framer.feed(stream[position:position + chunkSize])
+            for _ in framer.packets():
+                numPackets += 1
+        return numPackets
+
+    for noiseProbability in [0.0, 0.1]:
+        stream = makeStream(20000, noiseProbability)
+        results = [('byte wise loop', byteWiseLoop, (stream,))]
+        for chunkSize in [1, 16, 256, 4096]:
+            results.append(('framer, %4d byte chunks' % chunkSize, framerLoop, (stream, chunkSize)))
+        print 'stream with %d bytes, noise probability %.1f' % (len(stream), noiseProbability)
+        for name, function, args in results:
+            startTime = time.time()
+            numPackets = function(*args)
+            duration = time.time() - startTime
+            print '  %-26s %6d packets %10.0f bytes/s' % (name, numPackets, len(stream) / duration)
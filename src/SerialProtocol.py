@@ -1,20 +1,30 @@
 #! /usr/bin/python
 # -*- coding: utf-8 -*-
+import struct, threading
+from collections import OrderedDict
 from common.DataConverter import DataConverter
+try:
+    import numpy
+except ImportError: # numpy is optional, checksums of long packets are just computed slower without it
+    numpy = None
 
 class SerialProtocol:
     logLevel = 10
     serialTimeout = 0.030 # [sec]
     broadcastId = 0xfe
+    readGapThreshold = 4 # [bytes] unrequested bytes that may be read to merge two reads into one
+    maxReadLength = 0xff - 2 # data bytes fitting into one answer packet
+    structCacheSize = 64 # number of compiled memory ranges to keep
+    vectorChecksumLength = 64 # [bytes] sum longer packets with numpy
 
     def __init__(self, protocolName='RobotisServo'):
         global memoryFields
         self.setProtocol(protocolName)
         self.availableProtocolNames = memoryFields.keys()
 
-    def log(self, level, message):
+    def log(self, level, message, *args):
         if level < self.logLevel:
-            print message
+            print message % args if args else message
 
     def sendPacket(self):
         self.log(0, 'sendPacket is not implemented')
@@ -22,37 +32,21 @@ class SerialProtocol:
     def receivePacket(self):
         self.log(0, 'sendPacket is not implemented')
 
-    def calulateChecksum(self, data):
-        checksum = 0
-        if type(data[0]) == int:
-            for byte in data:
-                checksum = (checksum + byte) & 0xff
+    def calulateChecksum(self, data, start=0, end=None):
+        # checksum of data[start:end], data may be a bytearray, str, memoryview or a list of ints
+        if end is None:
+            end = len(data)
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        if numpy and end - start >= self.vectorChecksumLength and not isinstance(data, list):
+            checksum = int(numpy.frombuffer(data, numpy.uint8, end - start, start).sum())
+        elif isinstance(data, str):
+            checksum = sum(bytearray(data[start:end]))
         else:
-            for char in data:
-                checksum = (checksum + ord(char)) & 0xff
+            checksum = sum(data[start:end])
         checksum = (~checksum) & 0xff
         return checksum
 
-    def scanForServos(self):
-        self.log(2, 'Start scanning for servos...')
-        self.sendPacket(self.broadcastId, 'PING', [])
-        servoIdList = []
-        failureCount = 0
-        lastServoId = -1
-
-        while (failureCount * (self.serialTimeout / 0.0012)) < (253 - lastServoId):
-
-            packetServoId, _, _, _, _ = self.parsePacket(self.receivePacket())
-
-            if packetServoId != None:
-                servoIdList.append(packetServoId)
-                failureCount = 0
-                lastServoId = packetServoId
-            else:
-                failureCount += 1
-
-        return servoIdList
-
     def parsePacket(self, packetBytes):
         if len(packetBytes) < 6:
             return (None, None, None, None, None)
@@ -62,28 +56,137 @@ class SerialProtocol:
         instruction = packetBytes[4]
         data = packetBytes[5:-1]
         checksum = packetBytes[-1]
-        realChecksum = self.calulateChecksum(packetBytes[2:-1])
+        realChecksum = self.calulateChecksum(packetBytes, 2, len(packetBytes) - 1)
         return (servoId, instruction, data, checksum, realChecksum)
 
+    def getInstructionName(self, instruction):
+        try:
+            return self.instructionName.get(int(instruction), '? 0x%02x ?' % int(instruction))
+        except (ValueError, TypeError):
+            return str(instruction)
+
+    def planReads(self, fieldRequests, maxGap=None):
+        # merge the requested (servo id, field name) pairs into as few (servo id, address, length) reads as possible
+        if maxGap is None:
+            maxGap = self.readGapThreshold
+        fieldRanges = {}
+        for servoId, fieldName in fieldRequests:
+            fieldInfo = self.memoryInfo[fieldName]
+            fieldRanges.setdefault(servoId, set()).add((fieldInfo['address'], fieldInfo['size']))
+        readPlan = []
+        for servoId in sorted(fieldRanges.keys()):
+            start = end = None
+            for address, size in sorted(fieldRanges[servoId]):
+                if start is not None and address <= end + maxGap and max(end, address + size) - start <= self.maxReadLength:
+                    end = max(end, address + size)
+                else:
+                    if start is not None:
+                        readPlan.append((servoId, start, end - start))
+                    start, end = address, address + size
+            readPlan.append((servoId, start, end - start))
+        return readPlan
+
+    def groupReads(self, readPlan):
+        # group reads of the same address range, so they can be done with one synchronized read
+        readGroups = {}
+        for servoId, address, length in readPlan:
+            readGroups.setdefault((address, length), []).append(servoId)
+        return readGroups
+
+    def getMemoryStruct(self, memoryAddress, length):
+        # compiled struct and field list for all fields completely inside the memory range, least recently used cache
+        key = (memoryAddress, length)
+        with self.structCacheLock:
+            entry = self.structCache.pop(key, None)
+            if entry is None:
+                fields = []
+                formatString = '<'
+                position = memoryAddress
+                for fieldInfo in self.memoryStructFields:
+                    if fieldInfo['address'] < memoryAddress or fieldInfo['address'] + fieldInfo['size'] > memoryAddress + length:
+                        continue
+                    formatString += 'x' * (fieldInfo['address'] - position) + fieldInfo['structFormat']
+                    position = fieldInfo['address'] + fieldInfo['size']
+                    fields.append(fieldInfo)
+                entry = (struct.Struct(formatString), fields)
+            self.structCache[key] = entry
+            if len(self.structCache) > self.structCacheSize:
+                self.structCache.popitem(last=False)
+        return entry
+
+    def decodeMemory(self, memoryAddress, data):
+        # decode all fields contained in data with one unpack call, returns a list of (fieldInfo, value)
+        memoryStruct, fields = self.getMemoryStruct(memoryAddress, len(data))
+        values = memoryStruct.unpack_from(buffer(data))
+        result = []
+        index = 0
+        for fieldInfo in fields:
+            numElements = fieldInfo['numElements']
+            scale = fieldInfo['scale']
+            if numElements == 1:
+                value = values[index]
+                if scale:
+                    value = value * scale
+            else:
+                value = values[index:index + numElements]
+                if scale:
+                    value = tuple(element * scale for element in value)
+            index += numElements
+            result.append((fieldInfo, value))
+        return result
+
+    def makeNumpyDtype(self):
+        # structured dtype of the whole memory, raw values (fixed point fields are not scaled)
+        import numpy # numpy is optional, so only import it when needed
+        names, formats, offsets = [], [], []
+        for fieldInfo in self.memoryStructFields:
+            baseFormat = numpy.dtype('<' + fieldInfo['structFormat'].lstrip('0123456789'))
+            names.append(fieldInfo['name'])
+            if fieldInfo['numElements'] == 1:
+                formats.append(baseFormat)
+            else:
+                formats.append((baseFormat, (fieldInfo['numElements'],)))
+            offsets.append(fieldInfo['address'])
+        return numpy.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': self.memoryInfo['memorySize']})
+
+    def makeSyncWriteData(self, memoryAddress, servoDataDict):
+        # split the servo data into as few sync write parameter lists as fit into the packet length byte
+        servoIdList = sorted(servoDataDict.keys())
+        length = len(servoDataDict[servoIdList[0]])
+        servosPerPacket = max(1, (0xff - 2 - 2) // (1 + length))
+        dataLists = []
+        for index in range(0, len(servoIdList), servosPerPacket):
+            data = [memoryAddress, length]
+            for servoId in servoIdList[index:index + servosPerPacket]:
+                data += [servoId] + list(servoDataDict[servoId])
+            dataLists.append(data)
+        return dataLists
+
     def makePacket(self, servoId, instruction, data):
         try:
             instructionCode = int(instruction)
         except:
             instructionCode = self.instructionCode.get(str(instruction), None)
             if instructionCode == None:
-                self.log(0, 'Unknown instruction "%s"' % instruction)
+                self.log(0, 'Unknown instruction "%s"', instruction)
                 return None
-        packetString = '\xff\xff'
-        packetString += chr(servoId)
-        packetString += chr(1 + len(data) + 1)
-        packetString += chr(instructionCode)
-        for byte in data:
-            if type(byte) == int:
-                packetString += chr(byte)
-            else:
-                packetString += str(byte)
-        packetString += chr(self.calulateChecksum(packetString[2:]))
-        return packetString
+        if isinstance(data, (str, bytearray)):
+            dataBytes = data
+        else:
+            try:
+                dataBytes = bytearray(data) # ints and single characters
+            except (TypeError, ValueError):
+                dataBytes = bytearray().join(bytearray([byte]) if type(byte) == int else bytearray(str(byte)) for byte in data)
+        # build the packet in one buffer: ff ff id length instruction data checksum
+        packet = bytearray(6 + len(dataBytes))
+        packet[0] = 0xff
+        packet[1] = 0xff
+        packet[2] = servoId
+        packet[3] = 1 + len(dataBytes) + 1
+        packet[4] = instructionCode
+        packet[5:-1] = dataBytes
+        packet[-1] = self.calulateChecksum(packet, 2, len(packet) - 1)
+        return packet
 
 
     def allServosGetPosition(self, servos):
@@ -114,13 +217,18 @@ class SerialProtocol:
         global memoryFields, instructionSets
         self.memoryFieldsKey = protocolName
         self.memoryInfo = {'fieldNames' : [], 'memorySize': 0}
+        self.memoryStructFields = []
+        self.structCacheLock = threading.Lock()
+        self.structCache = OrderedDict()
         if protocolName not in memoryFields:
-            self.log(0, 'Unknown memory structure "%s"' % protocolName)
+            self.log(0, 'Unknown memory structure "%s"', protocolName)
             return
         index = 0
         address = 0
         converter = DataConverter()
+        inRam = ramStartFields.get(protocolName) is None
         for memoryField in memoryFields[protocolName]:
+            inRam = inRam or memoryField['name'] == ramStartFields.get(protocolName)
             fieldBaseType = memoryField['type'].split(' ')[-1]
             arrayElements = fieldBaseType.split('[')
             if len(arrayElements) > 1:
@@ -131,17 +239,24 @@ class SerialProtocol:
 
             typeSize = converter.getByteSize(fieldBaseType)
             fieldSize = typeSize * arraySize
+            fieldTypeName = memoryField['type'].split('[')[0]
+            structFormat = converter.formatCharacter.get(fieldTypeName, 'i')
+            if arraySize > 1:
+                structFormat = '%d%s' % (arraySize, structFormat)
 
             self.memoryInfo['fieldNames'].append(memoryField['name'])
             self.memoryInfo[address] = {
                 'name'        : memoryField['name'],
                 'size'        : fieldSize,
-                'type'        : memoryField['type'].split('[')[0],
+                'type'        : fieldTypeName,
                 'numElements' : arraySize,
                 'writable'    : memoryField.get('writable', False),
+                'volatile'    : inRam, # may change without us writing it, so it is never cached
                 'address'     : address,
                 'index'       : index,
                 'makeToolTip' : memoryField.get('makeToolTip', repr),
+                'structFormat': structFormat,
+                'scale'       : converter.fixedPointScale.get(fieldTypeName),
             }
             self.memoryInfo[memoryField['name']] = self.memoryInfo[address]
             index += 1
@@ -149,6 +264,10 @@ class SerialProtocol:
 
         self.memoryInfo['memorySize'] = address
 
+        # precompile the struct of the whole memory, sub ranges get compiled on demand
+        self.memoryStructFields = [self.memoryInfo[fieldName] for fieldName in self.memoryInfo['fieldNames']]
+        self.getMemoryStruct(0, address)
+
         self.instructionName = {}
         self.instructionCode = {}
         self.instructionDescription = {}
@@ -158,6 +277,15 @@ class SerialProtocol:
             self.instructionDescription[instruction[0]] = instruction[2] # code to description
             self.instructionDescription[instruction[1]] = instruction[2] # name to description
 
+        # protocols name their synchronized instructions differently
+        self.syncWriteInstruction = None
+        for instructionName in ['SYNC_WRITE', 'SYNCHRONIZED WRITE DATA']:
+            if instructionName in self.instructionCode:
+                self.syncWriteInstruction = instructionName
+        self.syncReadInstruction = None
+        if 'SYNCHRONIZED READ DATA' in self.instructionCode:
+            self.syncReadInstruction = 'SYNCHRONIZED READ DATA'
+
 
 instructionSets = {
     'RobotisServo': [
@@ -275,6 +403,15 @@ memoryFields['SPIConnector'] = memoryFields['Common'] + [
     {'name': 'value', 'type': 'signed short', 'writable': True},
 ]
 
+# the first field of the ram of each servo type, only the eeprom fields in front of it keep their value until we write them
+# (the servo itself, another controller or a power cycle can change any ram field, i.e. an alarm shutdown clears TorqueEnable)
+ramStartFields = {
+    'RobotisServo': 'TorqueEnable',
+    'AVRServo': 'TorqueEnable',
+    'SPIConnector': 'positionRoll',
+    'DDServo': 'desiredPosition',
+}
+
 ddFlagStrings = [
     'FLAG_MOTOR_POWER_ACTIVATED',
     'FLAG_LOGGING_ACTIVATED',
@@ -311,6 +448,15 @@ ddErrorStrings = [
     'ERROR_DATA_LOSS',
 ]
 
+class HexDump:
+    # formats data as hex bytes only when converted to a string, so it can be passed to log() for free
+    def __init__(self, data, prefix=''):
+        self.data = data
+        self.prefix = prefix
+
+    def __str__(self):
+        return self.prefix + ' '.join(['%02x' % byte for byte in bytearray(self.data)])
+
 def toBinString(flags):
     return str(flags & 1) if flags <= 1 else toBinString(flags >> 1) + str(flags & 1)
 
@@ -1,181 +1,843 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-import serial
-
-from PyQt4.QtCore import QThread, QMutex, pyqtSignal as Signal
-
-from SerialProtocol import SerialProtocol
+import serial, thread, time, Queue
+from functools import wraps
+
+from PyQt4.QtCore import QThread, pyqtSignal as Signal
+
+from common.MonotonicClock import monotonic
+
+from SerialProtocol import SerialProtocol, HexDump
+from PacketFramer import PacketFramer
+from Transaction import Transaction
+from BusCapture import BusRecorder, BusCapture, RECEIVED, SENT
+from BusSniffer import BusSniffer
+from TransactionStatistics import TransactionStatistics
+from ServoMemory import ServoMemory
+try:
+    from FleetMemory import FleetMemory
+except ImportError: # numpy is not installed
+    FleetMemory = None
+
+def queued(function):
+    # calls from other threads are put into the command queue and executed by the serial thread later on,
+    # calls from within the serial thread (or while it is not running) are executed immediately
+    @wraps(function)
+    def queuedFunction(self, *args):
+        if self.isRunning() and self.workerThreadId != thread.get_ident():
+            self.commandQueue.put((function, args))
+        else:
+            return function(self, *args)
+    return queuedFunction
 
 class SerialThread(QThread, SerialProtocol):
     logMessage = Signal(int, str)
     serialConnectionError = Signal()
     servoPing = Signal(int)
-    servoData = Signal(int, int, object)
+    baudrateFound = Signal(int, list)
+    baudrateChanged = Signal(int)
+    busSpeedOptimized = Signal(object)
+    servoDataBatch = Signal(object)
     packetSent = Signal(object)
     packetReceived = Signal(object)
+    busStatistics = Signal(object)
+    transactionStatistics = Signal(object)
     minServoId = 0
-    maxServoId = 25
+    maxServoId = 253
+    batchInterval = 0.05 # [sec] maximum time results are held back to be handed over in one batch
+    statisticsInterval = 1.0 # [sec] time between two statistics updates
+    maxReturnDelay = 0.000508 # [sec] longest return delay time a servo can be set to (254 * 2 us)
+    adapterLatency = 0.02 # [sec] usb serial adapters hold received bytes back for up to their latency timer
+    pollInterval = 0.0002 # [sec] sleep time while polling for answers without blocking on the serial port
+    baudrateTolerance = 0.03 # servos still understand a baud rate this much off
+    stressReadRounds = 20 # reads of every servo to measure the poll rate and to verify new bus settings
+    stressReadLength = 8
+    settleTime = 0.05 # [sec] servos need some time to store new settings in their eeprom
 
     def __init__(self, parent):
         QThread.__init__(self)
-        SerialProtocol.__init__(self)
+        self.servoMemory = {}
+        self.fleetMemory = None
+        SerialProtocol.__init__(self) # sets up the memory images
         self.parent = parent
         self.running = False
+        self.listening = False
+        self.workerThreadId = None
+        self.commandQueue = Queue.Queue()
+        self.servoDataBuffer = []
+        self.lastBatchTime = 0
+        self.lastReadTime = None # monotonic time of the last data received from the serial port
+        self.emitPings = True
+        self.recorder = None
+        self.replay = None
+        self.sniffer = None
+        self.lastStatisticsTime = 0
+        self.statistics = TransactionStatistics(self.broadcastId)
+        self.lastTransactionStatisticsTime = 0
         self.serialPort = serial.Serial()
         self.serialTimeout = 0.1
-        self.mutex = QMutex(QMutex.Recursive)
+        self.framer = PacketFramer()
+        self.pendingTransactions = []
         self.nextPacketIsAServoAnswerFromId = -1
         self.lastReqeustPacket = {}
 
 
     def __del__(self):
+        self.stop()
         self.closeSerialPort()
 
 
-    def log(self, level, message):
+    def log(self, level, message, *args):
+        # check the level before formatting the message, so suppressed messages cost (almost) nothing
+        if level > self.logLevel:
+            return
+        if args:
+            message = message % args
         self.logMessage.emit(level, message)
 
 
+    def setLogLevel(self, logLevel):
+        self.logLevel = logLevel
+
+
+    def start(self):
+        self.running = True
+        QThread.start(self)
+
+
+    def stop(self):
+        # let the serial thread finish all queued commands and wait for it
+        if self.isRunning():
+            self.running = False
+            self.commandQueue.put(None) # wake up the thread
+            self.wait()
+
+
+    def pendingCommands(self):
+        return self.commandQueue.qsize()
+
+
+    def run(self):
+        self.workerThreadId = thread.get_ident()
+        while self.running or not self.commandQueue.empty():
+            try:
+                if self.listening or self.replay:
+                    command = self.commandQueue.get_nowait()
+                else:
+                    command = self.commandQueue.get(timeout=self.batchInterval)
+            except Queue.Empty:
+                if self.replay:
+                    self.replayRecords()
+                elif self.listening:
+                    self.sniffPackets()
+                self.emitServoDataBatch()
+                continue
+
+            if command is not None:
+                function, args = command
+                try:
+                    function(self, *args)
+                except Exception, e:
+                    self.log(0, 'Error executing %s%s: %s', function.__name__, repr(args), e)
+
+            if self.commandQueue.empty() or monotonic() - self.lastBatchTime > self.batchInterval:
+                self.emitServoDataBatch()
+        self.emitServoDataBatch()
+
+
+    def addServoData(self, servoId, addressOffset, packetData, timestamp=None):
+        # timestamp is the monotonic time the data was received at
+        self.servoDataBuffer.append((servoId, addressOffset, packetData, timestamp or monotonic()))
+
+
+    def emitServoDataBatch(self):
+        self.lastBatchTime = monotonic()
+        if self.servoDataBuffer:
+            servoDataBatch = self.servoDataBuffer
+            self.servoDataBuffer = []
+            self.servoDataBatch.emit(servoDataBatch)
+        if self.statistics.changed and self.lastBatchTime - self.lastTransactionStatisticsTime >= self.statisticsInterval:
+            self.lastTransactionStatisticsTime = self.lastBatchTime
+            self.transactionStatistics.emit(self.statistics.snapshot(self.lastBatchTime))
+
+
+    @queued
+    def resetStatistics(self):
+        self.statistics.reset()
+
+
+    @queued
     def openSerialPort(self, serialPortNameOrNumber, serialBaudrate):
         try:
             self.serialPort.port = str(serialPortNameOrNumber)
             self.serialPort.baudrate = serialBaudrate
             self.serialPort.timeout = self.serialTimeout
             self.serialPort.open()
+            self.framer.reset()
         except serial.serialutil.SerialException, e:
-            self.log(0, 'Error opening %s (Maybe it is already in use):\n%s' % (self.serialPort.name, e))
+            self.log(0, 'Error opening %s (Maybe it is already in use):\n%s', self.serialPort.name, e)
             self.serialConnectionError.emit()
         else:
-            self.log(1, 'Connected to serial port %s with %d baud' % (self.serialPort.portstr, self.serialPort.baudrate))
+            self.log(1, 'Connected to serial port %s with %d baud', self.serialPort.portstr, self.serialPort.baudrate)
+
+
+    def changeBaudrate(self, baudrate):
+        # reconfigure the open port instead of reopening it
+        try:
+            self.serialPort.baudrate = baudrate
+        except (ValueError, serial.serialutil.SerialException), e:
+            self.log(0, 'Error setting the baud rate to %d: %s', baudrate, e)
+            return False
+        self.serialPort.flushInput()
+        self.framer.reset()
+        return True
+
 
+    @queued
+    def setBaudrate(self, baudrate):
+        if self.changeBaudrate(baudrate):
+            self.log(1, 'Changed the baud rate of %s to %d', self.serialPort.portstr, self.serialPort.baudrate)
+            self.baudrateChanged.emit(int(self.serialPort.baudrate))
 
+
+    @queued
     def closeSerialPort(self):
-        # stop the reading thread before closing the serial port
-        if self.running:
-            self.running = False
-            self.log(3, 'Waiting for the serial thread...')
-            self.wait()
+        self.listening = False
+        self.expireTransactions(error='port closed')
         if self.serialPort.isOpen():
-            self.log(1, 'Closing the serial port %s' % self.serialPort.portstr)
+            self.log(1, 'Closing the serial port %s', self.serialPort.portstr)
             self.serialPort.close()
 
 
+    @queued
+    def setProtocol(self, protocolName):
+        SerialProtocol.setProtocol(self, protocolName)
+        self.clearServoMemory()
+
+
+    @queued
+    def clearServoMemory(self, servoIdList=None):
+        if servoIdList is None:
+            self.servoMemory = {}
+            if FleetMemory:
+                self.fleetMemory = FleetMemory(self.makeNumpyDtype(), self.memoryInfo)
+        for servoId in servoIdList or []:
+            self.servoMemory.pop(servoId, None)
+            if self.fleetMemory:
+                self.fleetMemory.remove([servoId])
+
+
+    def getServoMemory(self, servoId):
+        if servoId not in self.servoMemory:
+            self.servoMemory[servoId] = ServoMemory(self.memoryInfo)
+        return self.servoMemory[servoId]
+
+
+    def readFromCache(self, servoIdList, memoryAddress, length):
+        # hand over cached data right away and return the ids of the servos which need to be read
+        servoIdsToRead = []
+        for servoId in servoIdList:
+            servoMemory = self.servoMemory.get(servoId)
+            if servoMemory and servoMemory.isRangeCached(memoryAddress, length):
+                self.log(7, 'Reading data from servo id %d memory image ...', servoId)
+                self.addServoData(servoId, memoryAddress, servoMemory.getData(memoryAddress, length))
+            else:
+                servoIdsToRead.append(servoId)
+        return servoIdsToRead
+
+
+    @queued
+    def startRecording(self, fileName):
+        # record all raw data read from and written to the serial port
+        self.stopRecording()
+        try:
+            self.recorder = BusRecorder(fileName)
+        except IOError, e:
+            self.log(0, 'Error opening capture file %s: %s', fileName, e)
+        else:
+            self.log(1, 'Recording bus traffic to %s', fileName)
+
+
+    @queued
+    def stopRecording(self):
+        if self.recorder:
+            self.recorder.close()
+            self.log(1, 'Recorded %d bytes to %s', self.recorder.numBytes, self.recorder.fileName)
+            self.recorder = None
+
+
+    @queued
+    def startReplay(self, fileName, speed=1.0, startTime=None):
+        # feed a capture file through the packet evaluation as if the data came from the serial port,
+        # at speed times the recorded pace, or as fast as possible for a speed of 0
+        self.stopReplay()
+        try:
+            capture = BusCapture(fileName)
+        except IOError, e:
+            self.log(0, 'Error opening capture file %s: %s', fileName, e)
+            return
+        self.log(1, 'Replaying bus traffic from %s', fileName)
+        self.replay = {
+            'capture': capture,
+            'records': capture.records(startTime),
+            'speed': speed,
+            'framers': {RECEIVED: PacketFramer(), SENT: PacketFramer()},
+            'sniffer': BusSniffer(self, self.serialPort.baudrate),
+            'ownTraffic': False, # a capture of our own traffic has the sent requests in it
+            'nextRecord': None,
+            'clockOffset': None, # capture time - replay time * speed
+        }
+
+
+    @queued
+    def stopReplay(self):
+        if self.replay:
+            self.replay['capture'].close()
+            self.replay = None
+            self.emitServoDataBatch()
+            self.log(1, 'Replay finished')
+
+
+    def replayRecords(self):
+        # replay all records which are due, but return after batchInterval to keep the command queue going
+        replay = self.replay
+        stepEndTime = monotonic() + self.batchInterval
+        while monotonic() < stepEndTime:
+            if replay['nextRecord'] is None:
+                replay['nextRecord'] = next(replay['records'], None)
+                if replay['nextRecord'] is None:
+                    self.stopReplay()
+                    return
+            timestamp, direction, data = replay['nextRecord']
+            if replay['speed'] > 0:
+                if replay['clockOffset'] is None:
+                    replay['clockOffset'] = timestamp - monotonic() * replay['speed']
+                delay = (timestamp - replay['clockOffset']) / replay['speed'] - monotonic()
+                if delay > 0:
+                    time.sleep(min(delay, stepEndTime - monotonic(), self.batchInterval))
+                    continue
+            replay['nextRecord'] = None
+            self.replayData(timestamp, direction, data)
+
+
+    def replayData(self, timestamp, direction, data):
+        # the sniffer pairs the answers with their requests, by the direction for captures of our own traffic and
+        # like on a bus we only listen to for captures without sent data
+        replay = self.replay
+        replay['ownTraffic'] = replay['ownTraffic'] or direction == SENT
+        sent = direction == SENT if replay['ownTraffic'] else None
+        framer = replay['framers'][direction]
+        framer.feed(data)
+        self.lastReadTime = timestamp
+        for packet in framer.packets():
+            packet = bytearray(packet)
+            # the packet ended before the bytes which are still buffered behind it were received
+            packetTime = timestamp - framer.bufferedBytes() * replay['sniffer'].byteTime
+            self.handleSniffedPacket(replay['sniffer'].evaluatePacket(packetTime, packet, sent))
+            if direction == SENT:
+                self.packetSent.emit(packet)
+            else:
+                self.packetReceived.emit(packet)
+
+
+    @queued
+    def startListening(self):
+        # passively decode the traffic of another controller on the bus
+        self.sniffer = BusSniffer(self, self.serialPort.baudrate)
+        self.lastStatisticsTime = monotonic()
+        self.listening = True
+
+
+    def sniffPackets(self):
+        # read everything that is waiting (but block for at least one byte) and decode all complete packets in it,
+        # the gui only gets the decoded servo data batches and the statistics
+        if not self.serialPort.isOpen():
+            self.listening = False
+            return
+        data = self.serialPort.read(max(1, self.serialPort.inWaiting()))
+        self.lastReadTime = monotonic()
+        if data:
+            if self.recorder:
+                self.recorder.record(self.lastReadTime, RECEIVED, data)
+            for sniffedPacket in self.sniffer.feed(self.lastReadTime, data):
+                self.handleSniffedPacket(sniffedPacket)
+        if self.lastReadTime - self.lastStatisticsTime >= self.statisticsInterval:
+            self.lastStatisticsTime = self.lastReadTime
+            self.busStatistics.emit(self.sniffer.statistics(self.lastReadTime))
+
+
+    def handleSniffedPacket(self, sniffedPacket):
+        # answers are handled with the servo id they came from and the instruction and address of their request,
+        # which is a plain read of that servo for the answers to a synchronized read
+        timestamp, servoId, instruction, packetData, checksumOk, request = sniffedPacket
+        checkSumErrorString = '' if checksumOk else 'CKS ERR'
+        if request is None:
+            self.log(4, 'Request Id %3d %9s %s %s', servoId, self.getInstructionName(instruction), HexDump(packetData, 'DATA: '), checkSumErrorString)
+        else:
+            self.log(3, 'Answer  Id %3d Error: %02x %s %s', servoId, instruction, HexDump(packetData, 'DATA: '), checkSumErrorString)
+            if checksumOk:
+                self.handleAnswer(servoId, request['instructionName'], request['address'], packetData, timestamp)
+
+
+    def byteTime(self):
+        return 10.0 / self.serialPort.baudrate # start bit, 8 data bits and stop bit
+
+
+    def answerTime(self, requestLength, dataLength=0, returnDelay=None):
+        # [sec] time from the start of sending a request of requestLength bytes until the end of its answer on the bus,
+        # the write returns before the request has left the serial adapter, so the timing can't start at its end
+        if returnDelay is None:
+            returnDelay = self.maxReturnDelay
+        return returnDelay + (requestLength + 6 + dataLength) * self.byteTime()
+
+
+    def answerWindowEnd(self, startTime, requestLength):
+        # call right after flushing the request: a late flush means the request only just left, so the window closes
+        # after the later of both estimates, plus the time the usb serial adapter may hold the answer back
+        return max(startTime + self.answerTime(requestLength), monotonic() + self.answerTime(0)) + self.adapterLatency
+
+
+    def pollPackets(self, endTime):
+        # evaluate received packets without blocking on the serial port, until a packet arrived or endTime is reached
+        while self.serialPort.isOpen():
+            if self.receivePacket(block=False):
+                return True
+            now = monotonic()
+            if now >= endTime:
+                break
+            time.sleep(min(self.pollInterval, endTime - now))
+        return False
+
+
+    def broadcastPing(self):
+        # all servos answer a broadcast ping one after the other, so the reply window closes
+        # as soon as no answer came in for the time one more answer would take
+        startTime = monotonic()
+        transaction = self.submitTransaction(Transaction(self.broadcastId, 'PING', []))
+        self.serialPort.flush()
+        endTime = self.answerWindowEnd(startTime, 6)
+        while self.pollPackets(endTime):
+            endTime = monotonic() + self.answerTime(0) + self.adapterLatency
+        transaction.deadline = monotonic()
+        self.expireTransactions()
+        return transaction.answerIds
+
+
+    def sweepPing(self, servoIdList):
+        # ping one id after the other once the answer of the previous one has surely left the bus, a present servo
+        # would collide with the next ping otherwise, late answers are still matched by their id
+        transactions = []
+        for servoId in servoIdList:
+            if not self.serialPort.isOpen():
+                break
+            startTime = monotonic()
+            transaction = self.submitTransaction(Transaction(servoId, 'PING', []), self.answerTime(6) + self.adapterLatency)
+            self.serialPort.flush()
+            transactions.append(transaction)
+            endTime = self.answerWindowEnd(startTime, 6)
+            transaction.deadline = max(transaction.deadline, endTime)
+            while monotonic() < endTime and not transaction.isDone(): # the bus is free once the answer came in
+                self.pollPackets(endTime)
+            self.expireTransactions()
+        while [transaction for transaction in transactions if not transaction.isDone()]:
+            if not self.serialPort.isOpen():
+                self.expireTransactions(error='port closed')
+                break
+            self.pollPackets(min(transaction.deadline for transaction in transactions if not transaction.isDone()))
+            self.expireTransactions()
+        return [transaction.servoId for transaction in transactions if transaction.answers]
+
+
+    @queued
+    def scanForServos(self, broadcast=True):
+        # a broadcast ping finds most servos at once, all ids which did not answer it (maybe due to a collision)
+        # are pinged one by one, found servos are reported by servoPing right away
+        self.clearServoMemory()
+        if not self.serialPort.isOpen():
+            return []
+        self.log(2, 'Start scanning for servos...')
+        startTime = monotonic()
+        foundIds = set()
+        if broadcast:
+            foundIds.update(self.broadcastPing())
+        foundIds.update(self.sweepPing([servoId for servoId in range(self.minServoId, self.maxServoId + 1) if servoId not in foundIds]))
+        self.log(2, 'Found %d servos in %.2f seconds', len(foundIds), monotonic() - startTime)
+        return sorted(foundIds)
+
+
+    @queued
     def scanForServosSlow(self):
-        for servoId in range(self.minServoId, self.maxServoId):
-            self.sendPacket(servoId, 'PING', [])
+        # without the broadcast ping, for buses with servos which answer it at the same time
+        return self.scanForServos(False)
+
+
+    @queued
+    def discoverBaudrates(self, baudrateList, allDivisors=False):
+        # scan at every baud rate of the list, and probe every rate of the robotis baud rate divisor by a broadcast ping,
+        # the port ends up at the baud rate most servos answered at
+        if not self.serialPort.isOpen():
+            return {}
+        candidates = []
+        divisorBaudrates = [int(round(2000000.0 / (divisor + 1))) for divisor in range(255)] if allDivisors else []
+        for baudrate in list(baudrateList) + divisorBaudrates:
+            if not [candidate for candidate in candidates if abs(candidate - baudrate) < self.baudrateTolerance * candidate]:
+                candidates.append(baudrate)
+        self.log(1, 'Searching for servos at %d baud rates...', len(candidates))
+        startTime = monotonic()
+        originalBaudrate = self.serialPort.baudrate
+        servoIdsByBaudrate = {}
+        self.clearServoMemory()
+        self.emitPings = False # the servos found at other baud rates are no use for the gui
+        try:
+            for baudrate in candidates:
+                if not self.serialPort.isOpen():
+                    break
+                if not self.changeBaudrate(baudrate):
+                    continue
+                servoIdList = self.broadcastPing()
+                if servoIdList or baudrate in baudrateList:
+                    servoIdList += self.sweepPing([servoId for servoId in range(self.minServoId, self.maxServoId + 1) if servoId not in servoIdList])
+                # servos in between two neighbouring rates understand both, they are only reported at the first one
+                neighbourIds = set()
+                for foundBaudrate, foundIds in servoIdsByBaudrate.items():
+                    if abs(foundBaudrate - baudrate) < 2 * self.baudrateTolerance * foundBaudrate:
+                        neighbourIds.update(foundIds)
+                servoIdList = [servoId for servoId in servoIdList if servoId not in neighbourIds]
+                if servoIdList:
+                    servoIdsByBaudrate[baudrate] = sorted(set(servoIdList))
+                    self.log(1, 'Found servos %s at %d baud', servoIdsByBaudrate[baudrate], baudrate)
+                    self.baudrateFound.emit(baudrate, servoIdsByBaudrate[baudrate])
+        finally:
+            self.emitPings = True
+
+        self.log(1, 'Searched %d baud rates in %.1f seconds', len(candidates), monotonic() - startTime)
+        if servoIdsByBaudrate:
+            # on a tie the rate which was tried first wins, so the configured rates go before the divisor rates
+            foundBaudrates = [baudrate for baudrate in candidates if baudrate in servoIdsByBaudrate]
+            self.setBaudrate(max(foundBaudrates, key=lambda baudrate: len(servoIdsByBaudrate[baudrate])))
+        else:
+            self.setBaudrate(originalBaudrate)
+        for servoId in servoIdsByBaudrate.get(self.serialPort.baudrate, []):
+            self.servoPing.emit(servoId)
+        return servoIdsByBaudrate
+
+
+    def measurePollRate(self, servoIdList, rounds, maxErrors=None):
+        # read the present state of every servo several times, returns the reads per second and the number of failed reads,
+        # every failed read waits for the serial timeout, so it stops after a failed round or more than maxErrors failures
+        if maxErrors is None:
+            maxErrors = len(servoIdList)
+        fieldInfo = self.memoryInfo.get('PresentPosition', self.memoryInfo.get(0))
+        numReads = 0
+        numErrors = 0
+        startTime = monotonic()
+        for _ in range(rounds):
+            roundErrors = 0
+            for servoId in servoIdList:
+                numReads += 1
+                if self.sendPacket(servoId, 'READ', [fieldInfo['address'], self.stressReadLength]).error:
+                    roundErrors += 1
+                    if numErrors + roundErrors > maxErrors:
+                        break
+            numErrors += roundErrors
+            if roundErrors == len(servoIdList) or numErrors > maxErrors:
+                self.log(2, 'Stopped measuring the poll rate after %d failed reads', numErrors)
+                break
+        return numReads / (monotonic() - startTime), numErrors
 
 
+    def readBusSettings(self, servoIdList):
+        # current baud rate divisor and return delay time of the servos which answered
+        settings = {}
+        for servoId in servoIdList:
+            for fieldName in ['BaudRateDivisor', 'ReturnDelayTime']:
+                value = self.sendPacket(servoId, 'READ', [self.memoryInfo[fieldName]['address'], 1]).result()
+                if not value:
+                    self.log(2, 'Servo id %d did not answer reading %s', servoId, fieldName)
+                    settings.pop(servoId, None)
+                    break
+                settings.setdefault(servoId, {})[fieldName] = value[0]
+        return settings
+
+
+    def writeBusSettings(self, servoIdList, settings):
+        # the return delay is written first, as the servos won't understand anything after the baud rate change
+        for fieldName in ['ReturnDelayTime', 'BaudRateDivisor']:
+            self.syncWriteServoData(self.memoryInfo[fieldName]['address'], dict((servoId, [settings[servoId][fieldName]]) for servoId in servoIdList))
+        self.serialPort.flush()
+        time.sleep(self.settleTime)
+
+
+    def restoredBusSettingsDiffer(self, servoIdList, oldSettings):
+        # ids of the servos which don't answer or don't have their old settings
+        settings = self.readBusSettings(servoIdList)
+        return [servoId for servoId in servoIdList if settings.get(servoId) != oldSettings[servoId]]
+
+
+    @queued
+    def optimizeBusSpeed(self, servoIdList, baudrate, returnDelayTime=0):
+        # move all servos to a faster baud rate and a shorter return delay, verify every servo at the new settings
+        # by a burst of reads and restore the old settings if any of them failed
+        servoIdList = sorted(servoIdList)
+        if not self.serialPort.isOpen() or not servoIdList:
+            return None
+        if 'BaudRateDivisor' not in self.memoryInfo or 'ReturnDelayTime' not in self.memoryInfo:
+            self.log(0, 'The %s protocol has no baud rate divisor and return delay time', self.memoryFieldsKey)
+            return None
+        divisor = min(254, max(0, int(round(2000000.0 / baudrate)) - 1))
+        newBaudrate = int(round(2000000.0 / (divisor + 1)))
+        oldBaudrate = self.serialPort.baudrate
+        if not self.changeBaudrate(newBaudrate) or not self.changeBaudrate(oldBaudrate):
+            return None # the serial adapter does not support the baud rate
+
+        self.log(1, 'Measuring the poll rate of servo ids %s at %d baud...', servoIdList, oldBaudrate)
+        oldSettings = self.readBusSettings(servoIdList)
+        if len(oldSettings) < len(servoIdList):
+            self.log(0, 'Servo ids %s did not answer at the current settings', [servoId for servoId in servoIdList if servoId not in oldSettings])
+            return None
+        pollRateBefore, numErrors = self.measurePollRate(servoIdList, self.stressReadRounds)
+        if numErrors:
+            self.log(0, '%d reads failed at the current settings, fix the bus first', numErrors)
+            return None
+
+        self.log(1, 'Changing to %d baud (divisor %d) and a return delay time of %d...', newBaudrate, divisor, returnDelayTime)
+        newSettings = dict((servoId, {'BaudRateDivisor': divisor, 'ReturnDelayTime': returnDelayTime}) for servoId in servoIdList)
+        self.writeBusSettings(servoIdList, newSettings)
+        self.changeBaudrate(newBaudrate)
+        pollRateAfter, numErrors = self.measurePollRate(servoIdList, self.stressReadRounds)
+
+        result = {'baudrate': newBaudrate, 'returnDelayTime': returnDelayTime, 'pollRateBefore': pollRateBefore, 'pollRateAfter': pollRateAfter, 'rolledBack': False, 'failedIds': []}
+        if numErrors:
+            self.log(0, '%d reads failed at %d baud, restoring the old settings...', numErrors, newBaudrate)
+            self.writeBusSettings(servoIdList, oldSettings)
+            self.changeBaudrate(oldBaudrate)
+            # servos which missed the baud rate change are still at the old baud rate, but may have the new return delay
+            failedIds = self.restoredBusSettingsDiffer(servoIdList, oldSettings)
+            if failedIds:
+                self.log(1, 'Writing the old settings to servo ids %s again at %d baud...', failedIds, oldBaudrate)
+                self.writeBusSettings(failedIds, oldSettings)
+                failedIds = self.restoredBusSettingsDiffer(failedIds, oldSettings)
+            if failedIds:
+                self.log(0, 'Servo ids %s could not be restored to their old settings, try to find their baud rate', failedIds)
+            else:
+                self.log(1, 'All servos are back at their old settings')
+            result.update(baudrate=oldBaudrate, returnDelayTime=None, pollRateAfter=pollRateBefore, rolledBack=True, failedIds=failedIds)
+        else:
+            self.log(1, 'Poll rate improved from %.0f to %.0f reads per second', pollRateBefore, pollRateAfter)
+        self.baudrateChanged.emit(int(self.serialPort.baudrate))
+        self.busSpeedOptimized.emit(result)
+        return result
+
+
+    @queued
     def pingServos(self, servoIdList):
         servoIdList = list(servoIdList)
         for servoId in servoIdList:
             self.sendPacket(servoId, 'PING', [])
 
 
+    @queued
     def readAllServoData(self, servoIdList):
-        self.readServoData(servoIdList, 0, self.memoryInfo['memorySize'])
-
-
+        # only read the fields which are not cached in the memory image of each servo
+        for servoId in servoIdList:
+            servoMemory = self.getServoMemory(servoId)
+            cachedRanges = servoMemory.cachedRanges()
+            fieldRequests = [(servoId, fieldName) for fieldName in servoMemory.uncachedFieldNames()]
+            transactions = []
+            for _, memoryAddress, length in self.planReads(fieldRequests):
+                self.log(7, 'Reading data from servo id %d ...', servoId)
+                transactions.append(self.sendPacket(servoId, 'READ', [memoryAddress, length]))
+            if [transaction for transaction in transactions if transaction.error]:
+                continue
+            for memoryAddress, length in cachedRanges:
+                self.addServoData(servoId, memoryAddress, servoMemory.getData(memoryAddress, length))
+
+
+    @queued
+    def refreshServoData(self, servoIdList):
+        # forget the cached eeprom fields too and read everything again
+        self.clearServoMemory(servoIdList)
+        self.readAllServoData(servoIdList)
+
+
+    @queued
     def readServoData(self, servoIdList, memoryAddress, length):
-        servoIdList = list(servoIdList)
+        servoIdList = self.readFromCache(servoIdList, memoryAddress, length)
         for servoId in servoIdList:
-            self.log(7, 'Reading data from servo id %d ...' % servoId)
+            self.log(7, 'Reading data from servo id %d ...', servoId)
             self.sendPacket(servoId, 'READ', [memoryAddress, length])
 
 
+    @queued
+    def syncReadServoData(self, servoIdList, memoryAddress, length):
+        # read the same address range of several servos with one request, each servo answers in the given order
+        servoIdList = self.readFromCache(servoIdList, memoryAddress, length)
+        if len(servoIdList) < 2 or not self.syncReadInstruction:
+            return self.readServoData(servoIdList, memoryAddress, length)
+        self.log(7, 'Reading data from servo ids %s with one %s packet ...', servoIdList, self.syncReadInstruction)
+        transactions = []
+        for servoId in servoIdList:
+            # one transaction per expected answer, so the answers get assigned to the right servo
+            transaction = Transaction(servoId, 'READ', [memoryAddress, length], self.statistics.addTransaction)
+            transactions.append(transaction)
+        request = self.submitTransaction(Transaction(self.broadcastId, self.syncReadInstruction, [memoryAddress, length] + servoIdList))
+        if request.error:
+            return
+        for transaction in transactions:
+            transaction.sent(self.serialTimeout * len(servoIdList))
+        self.pendingTransactions += transactions
+        self.waitForTransactions(transactions)
+
+
+    @queued
     def writeServoData(self, servoIdList, memoryAddress, memoryData):
-        servoIdList = list(servoIdList)
         memoryDataList = list(memoryData)
-        for servoId in servoIdList:
-            self.log(7, 'Writing data to servo id %d ...' % servoId)
-            self.sendPacket(servoId, 'WRITE', [memoryAddress, ] + memoryDataList)
+        self.syncWriteServoData(memoryAddress, dict((servoId, memoryDataList) for servoId in servoIdList))
+
+
+    @queued
+    def syncWriteServoData(self, memoryAddress, servoDataDict):
+        # write data of the same length to the same address of several servos, using one sync write packet if possible
+        lengths = set(len(memoryData) for memoryData in servoDataDict.values())
+        for servoId, memoryData in servoDataDict.items():
+            self.getServoMemory(servoId).markDirty(memoryAddress, len(memoryData))
+        if len(servoDataDict) > 1 and self.syncWriteInstruction and len(lengths) == 1:
+            for data in self.makeSyncWriteData(memoryAddress, servoDataDict):
+                self.log(7, 'Writing data to servo ids %s with one %s packet ...', data[2::1 + data[1]], self.syncWriteInstruction)
+                self.sendPacket(self.broadcastId, self.syncWriteInstruction, data)
+        else:
+            for servoId in sorted(servoDataDict.keys()):
+                self.log(7, 'Writing data to servo id %d ...', servoId)
+                self.sendPacket(servoId, 'WRITE', [memoryAddress, ] + list(servoDataDict[servoId]))
 
 
+    @queued
     def resetServo(self, servoIdList):
         servoIdList = list(servoIdList)
         for servoId in servoIdList:
-            self.log(1, 'Resetting servo id %d ...' % servoId)
+            self.log(1, 'Resetting servo id %d ...', servoId)
+            self.clearServoMemory([servoId])
             self.sendPacket(servoId, 'RESET', [])
 
-    def run(self):
-        self.running = True
-        try:
-            while self.running:
-                self.receivePacket()
-        except:
-            self.running = False
-
-
-    def receivePacket(self):
-        receivedBytes = []
-        self.mutex.lock()
+    def receivePacket(self, block=True):
         while True:
             if not self.serialPort.isOpen():
-                self.mutex.unlock()
-                break
-            char = self.serialPort.read(1)
-            if char == '':
-                self.log(7, 'reveicePacket timed out after waiting for %0.3f seconds' % self.serialTimeout)
-                self.mutex.unlock()
-                receivedBytes = []
-                break
-
-            receivedBytes.append(ord(char))
-
-            while len(receivedBytes) >= 2 and receivedBytes[:2] != [0xff, 0xff]: # packet has to start with two 0xff
-                self.log(6, 'discarding byte: %02x (packet has to start with ff ff)' % (receivedBytes[0]))
-                receivedBytes.pop(0)
-
-            if len(receivedBytes) == 3 and receivedBytes[2] == 0xff: # id can't be 0xff
-                self.log(6, 'discarding byte: %02x (invalid id: %d)' % (receivedBytes[0], receivedBytes[2]))
-                receivedBytes.pop(0)
-
-            elif len(receivedBytes) >= 4 and receivedBytes[3] < 2: # length can't be smaler than 2
-                self.log(6, 'discarding byte: %02x (packet length to small: %d)' % (receivedBytes[0], receivedBytes[3]))
-                receivedBytes.pop(0)
-
-            elif len(receivedBytes) >= 6 and len(receivedBytes) == 4 + receivedBytes[3]: # only if we have the full packet
-                formatString = '%38s ' + '%02x ' * len(receivedBytes)
-                self.log(5, formatString % (('received hex',) + tuple(receivedBytes)))
-                self.evaluatePacket(receivedBytes)
-                self.mutex.unlock()
-                self.packetReceived.emit(receivedBytes)
+                return []
+
+            packet = self.framer.nextPacket()
+            if self.framer.discardedBytes:
+                self.log(6, 'discarded %d bytes (packet has to start with ff ff, a valid id and length)', self.framer.discardedBytes)
+                self.statistics.addDiscardedBytes(self.framer.discardedBytes)
+                self.framer.discardedBytes = 0
+            if packet is not None:
                 break
 
+            # read everything that is waiting, but block for at least one byte
+            waiting = self.serialPort.inWaiting()
+            if not block and not waiting:
+                return []
+            data = self.serialPort.read(max(1, waiting))
+            self.lastReadTime = monotonic()
+            if self.recorder and data:
+                self.recorder.record(self.lastReadTime, RECEIVED, data)
+            if data == '':
+                self.log(7, 'reveicePacket timed out after waiting for %0.3f seconds', self.serialTimeout)
+                return []
+            self.framer.feed(data)
+
+        receivedBytes = bytearray(packet)
+        self.log(5, '%38s %s', 'received hex', HexDump(receivedBytes))
+        self.evaluatePacket(receivedBytes)
+        self.packetReceived.emit(receivedBytes)
         return receivedBytes # return after evaluating the received packet
 
 
+    @queued
     def sendPacket(self, servoId, instruction, data):
-        self.sendData(self.makePacket(servoId, instruction, data))
+        transaction = self.submitTransaction(Transaction(servoId, self.getInstructionName(instruction), data))
+        self.waitForTransactions([transaction])
+        return transaction
+
+
+    def submitTransaction(self, transaction, timeout=None):
+        # send the request of a transaction without waiting for its answer, so several requests can be in flight
+        transaction.addCallback(self.statistics.addTransaction)
+        packet = self.makePacket(transaction.servoId, transaction.instructionName, transaction.data)
+        if packet is None or not self.serialPort.isOpen():
+            transaction.complete('not sent')
+            return transaction
+        self.writePacket(packet)
+        transaction.sent(timeout or self.serialTimeout)
+        if transaction.servoId != self.broadcastId or transaction.instructionName == 'PING':
+            self.pendingTransactions.append(transaction)
+        else:
+            transaction.complete() # broadcast packets are not answered
+        return transaction
+
 
-    def sendData(self, packetString):
+    def waitForTransactions(self, transactions):
+        while [transaction for transaction in transactions if not transaction.isDone()]:
+            if not self.serialPort.isOpen():
+                self.expireTransactions(error='port closed')
+                break
+            self.receivePacket()
+            self.expireTransactions()
+
+
+    def expireTransactions(self, error='timeout'):
+        now = monotonic()
+        for transaction in list(self.pendingTransactions):
+            if error != 'timeout' or transaction.expired(now):
+                self.pendingTransactions.remove(transaction)
+                if transaction.answers: # broadcast pings collect answers until their deadline
+                    transaction.complete()
+                else:
+                    self.log(7, '%r failed: %s', transaction, error)
+                    transaction.complete(error)
+
+
+    def matchTransaction(self, servoId):
+        # the oldest pending transaction addressed to this servo, or a broadcast ping which any servo may answer
+        broadcastTransaction = None
+        for transaction in self.pendingTransactions:
+            if transaction.servoId == servoId:
+                return transaction
+            if broadcastTransaction is None and transaction.servoId == self.broadcastId:
+                broadcastTransaction = transaction
+        return broadcastTransaction
+
+
+    @queued
+    def sendData(self, packet):
         if not self.serialPort.isOpen():
             return
-        if type(packetString) is not str:
-            packetString = ''.join(packetString)
-        packetBytes = []
-        for char in packetString:
-            packetBytes.append(ord(char))
-        formatString = '%38s ' + '%02x ' * len(packetBytes)
-        self.mutex.lock()
-        self.log(6, formatString % (('sending hex',) + tuple(packetBytes)))
-        self.evaluatePacket(packetBytes, sending=True)
-        self.serialPort.flushInput() # purge input buffer
-        self.serialPort.write(packetString)
-#        self.serialPort.flush()
-        self.mutex.unlock()
-        self.packetSent.emit(packetBytes)
+        self.writePacket(packet)
         self.receivePacket()
 
 
+    def writePacket(self, packet):
+        if type(packet) is not bytearray:
+            packet = bytearray(packet) # raw data from the gui is a list of characters
+        self.log(6, '%38s %s', 'sending hex', HexDump(packet))
+        self.evaluatePacket(packet, sending=True)
+        if not self.pendingTransactions:
+            self.serialPort.flushInput() # purge input buffer
+            self.framer.reset()
+        self.serialPort.write(packet)
+#        self.serialPort.flush()
+        if self.recorder:
+            self.recorder.record(monotonic(), SENT, packet)
+        self.packetSent.emit(packet)
+
+
     def evaluatePacket(self, packetBytes, sending=False):
         servoId, instruction, packetData, packetChecksum, realChecksum = self.parsePacket(packetBytes)
         if servoId == None:
             self.log(0, 'Packet not parsable')
             return
 
-        formatString = 'DATA: ' + '%02x ' * len(packetData)
-        dataString = formatString % tuple(packetData)
+        dataString = HexDump(packetData, 'DATA: ')
 
         if (packetChecksum == realChecksum):
             checkSumErrorString = ''
@@ -193,10 +855,16 @@ class SerialThread(QThread, SerialProtocol):
                 addressName = 'UnknownAddress'
         reqeustPacket = {'servoId' : servoId, 'instructionName' : instructionName, 'addressOffset' : addressOffset, 'dataString' : dataString}
 
-        if sending or (servoId != self.nextPacketIsAServoAnswerFromId and self.nextPacketIsAServoAnswerFromId != self.broadcastId):
+        transaction = None
+        if not sending:
+            transaction = self.matchTransaction(servoId)
+            if transaction is None and packetChecksum != realChecksum:
+                self.statistics.addUnmatchedChecksumError()
+
+        if transaction is None and (sending or (servoId != self.nextPacketIsAServoAnswerFromId and self.nextPacketIsAServoAnswerFromId != self.broadcastId)):
             # this is a request packet from the controller
 
-            self.log(4, 'Request Id %3d %9s %-18s %s %s' % (servoId, instructionName, addressName, dataString, checkSumErrorString))
+            self.log(4, 'Request Id %3d %9s %-18s %s %s', servoId, instructionName, addressName, dataString, checkSumErrorString)
 
             self.lastReqeustPacket = reqeustPacket
             self.nextPacketIsAServoAnswerFromId = servoId
@@ -205,13 +873,38 @@ class SerialThread(QThread, SerialProtocol):
 
             # this is an answer packet from a servo
             errorCode = instruction
-            self.log(3, 'Answer  Id %3d Error: %02x %-18s %s %s' % (servoId, errorCode, '', dataString, checkSumErrorString))
-
-            if (packetChecksum == realChecksum):
-                instructionName = self.lastReqeustPacket.get('instructionName')
-                if instructionName == 'PING':
-                    self.log(2, 'Found servo with id %d' % servoId)
-                    self.servoPing.emit(servoId)
-
-                elif instructionName in ['READ', 'WRITE', 'REG_WRITE']:
-                    self.servoData.emit(self.lastReqeustPacket.get('servoId'), self.lastReqeustPacket.get('addressOffset'), packetData)
+            self.log(3, 'Answer  Id %3d Error: %02x %-18s %s %s', servoId, errorCode, '', dataString, checkSumErrorString)
+
+            if transaction is not None:
+                # answer to one of our own requests
+                if transaction.servoId != self.broadcastId:
+                    self.pendingTransactions.remove(transaction)
+                if (packetChecksum == realChecksum):
+                    transaction.addAnswer(errorCode, packetData, servoId)
+                    self.handleAnswer(servoId, transaction.instructionName, transaction.address, packetData)
+                    if transaction.servoId != self.broadcastId:
+                        transaction.complete()
+                        self.log(7, '%r answered after %.1f ms', transaction, transaction.latency() * 1000)
+                elif transaction.servoId != self.broadcastId:
+                    transaction.complete('checksum error')
+
+            elif (packetChecksum == realChecksum):
+                # answer to a request we only listened to, answers carry the id of the servo, which differs from the
+                # request's for broadcasts, only an answer without a servo id is credited to the request's
+                answerId = servoId if servoId != self.broadcastId else self.lastReqeustPacket.get('servoId')
+                self.handleAnswer(answerId, self.lastReqeustPacket.get('instructionName'), self.lastReqeustPacket.get('addressOffset'), packetData)
+
+
+    def handleAnswer(self, servoId, instructionName, addressOffset, packetData, timestamp=None):
+        timestamp = timestamp or self.lastReadTime
+        if instructionName == 'PING':
+            self.log(2, 'Found servo with id %d', servoId)
+            if self.emitPings:
+                self.servoPing.emit(servoId)
+
+        elif instructionName in ['READ', 'WRITE', 'REG_WRITE']:
+            if instructionName == 'READ' and len(packetData) > 0:
+                self.getServoMemory(servoId).update(addressOffset, packetData, timestamp)
+                if self.fleetMemory:
+                    self.fleetMemory.update(servoId, addressOffset, packetData)
+            self.addServoData(servoId, addressOffset, packetData, timestamp)
@@ -0,0 +1,227 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+import os, sys, pty, tty, termios, fcntl, array, select, threading, random, time, argparse
+
+from SerialProtocol import SerialProtocol
+from PacketFramer import PacketFramer
+
+# instructions of the different protocols, which do the same thing
+instructionAliases = {
+    'WRITE PENDING DATA': 'REG_WRITE',
+    'TRIGGER PENDING DATA': 'ACTION',
+    'SYNCHRONIZED WRITE DATA': 'SYNC_WRITE',
+    'SYNCHRONIZED READ DATA': 'SYNC_READ',
+}
+
+# terminal speed constants to baud rates, to find out which baud rate the other side of the pty has set
+terminalSpeeds = dict((getattr(termios, name), int(name[1:])) for name in dir(termios) if name[0] == 'B' and name[1:].isdigit())
+TCGETS2 = 0x802C542A # linux ioctl of struct termios2, which has the actual baud rate, also for non standard rates
+
+class EmulatedServo:
+    # memory image of one servo and its pending REG_WRITE
+
+    def __init__(self, protocol, servoId, baudrate, returnDelayTime):
+        self.protocol = protocol
+        self.servoId = servoId
+        self.memory = bytearray(protocol.memoryInfo['memorySize'])
+        self.registeredWrite = None
+        self.defaultReturnDelayTime = returnDelayTime
+        self.setField('servoId', servoId)
+        self.setField('StatusReturnLevel', 2)
+        self.setField('statusReturnLevel', 2)
+        self.setField('ReturnDelayTime', returnDelayTime)
+        self.setField('statusReturnDelayTime', returnDelayTime)
+        self.setField('BaudRateDivisor', int(round(2000000.0 / baudrate)) - 1)
+
+    def setField(self, fieldName, value):
+        # little endian, like all servo memory
+        fieldInfo = self.protocol.memoryInfo.get(fieldName)
+        if fieldInfo:
+            for byte in range(min(fieldInfo['size'], 4)):
+                self.memory[fieldInfo['address'] + byte] = (max(0, value) >> (8 * byte)) & 0xff
+
+    def getField(self, fieldName, default=None):
+        fieldInfo = self.protocol.memoryInfo.get(fieldName)
+        if not fieldInfo:
+            return default
+        return sum(self.memory[fieldInfo['address'] + byte] << (8 * byte) for byte in range(min(fieldInfo['size'], 4)))
+
+    def read(self, address, length):
+        return self.memory[address:address + length]
+
+    def write(self, address, data):
+        data = bytearray(data)[:max(0, len(self.memory) - address)]
+        self.memory[address:address + len(data)] = data
+
+    def baudrate(self):
+        # baud rate of the robotis divisor register, None if the protocol has no such register
+        divisor = self.getField('BaudRateDivisor')
+        if divisor is None:
+            return None
+        return 2000000.0 / (divisor + 1)
+
+    def returnDelay(self):
+        # [s] the delay register counts in 2 us steps
+        return 2e-6 * self.getField('ReturnDelayTime', self.getField('statusReturnDelayTime', 0))
+
+    def answers(self, instructionName):
+        # status return level 0 answers only pings, 1 only pings and reads, 2 everything
+        level = self.getField('StatusReturnLevel', self.getField('statusReturnLevel', 2))
+        return level >= 2 or instructionName == 'PING' or (level == 1 and instructionName in ['READ', 'SYNC_READ'])
+
+
+class ServoEmulator(threading.Thread):
+    # a fleet of virtual servos behind a pseudo terminal, SerialThread can open the slave side like a usb serial adapter
+    # and gets answers with the timing of a real bus (transmission time of every byte and the return delay of each servo)
+
+    def __init__(self, protocolName='RobotisServo', servoIdList=range(1, 11), baudrate=1000000, returnDelayTime=250, noiseProbability=0.0, dropProbability=0.0):
+        threading.Thread.__init__(self, name='ServoEmulator')
+        self.daemon = True
+        self.protocol = SerialProtocol(protocolName)
+        self.protocol.logLevel = 0 # don't print anything
+        self.defaultBaudrate = baudrate
+        self.noiseProbability = noiseProbability # probability of random bytes before an answer
+        self.dropProbability = dropProbability # probability of an answer getting lost
+        self.random = random.Random(42)
+        self.servos = {}
+        for servoId in servoIdList:
+            self.servos[servoId] = EmulatedServo(self.protocol, servoId, baudrate, returnDelayTime)
+        self.masterFd, self.slaveFd = pty.openpty()
+        tty.setraw(self.slaveFd)
+        self.portName = os.ttyname(self.slaveFd)
+        self.framer = PacketFramer()
+        self.running = False
+        self.numRequests = 0
+        self.numAnswers = 0
+
+    def busBaudrate(self):
+        # the baud rate the serial port on the slave side is set to
+        if sys.platform.startswith('linux'):
+            termios2 = array.array('i', [0] * 64)
+            fcntl.ioctl(self.slaveFd, TCGETS2, termios2)
+            return termios2[10] # c_ospeed
+        speed = termios.tcgetattr(self.slaveFd)[5]
+        return terminalSpeeds.get(speed, self.defaultBaudrate)
+
+    def stop(self):
+        self.running = False
+        self.join()
+        os.close(self.masterFd)
+        os.close(self.slaveFd)
+
+    def run(self):
+        self.running = True
+        while self.running:
+            readable, _, _ = select.select([self.masterFd], [], [], 0.1)
+            if not readable:
+                continue
+            data = os.read(self.masterFd, 4096)
+            self.framer.feed(data)
+            for packet in self.framer.packets():
+                self.handleRequest(bytearray(packet))
+
+    def handleRequest(self, packet):
+        servoId, instruction, data, checksum, realChecksum = self.protocol.parsePacket(packet)
+        if servoId is None or checksum != realChecksum:
+            return
+        self.numRequests += 1
+        instructionName = self.protocol.instructionName.get(instruction)
+        instructionName = instructionAliases.get(instructionName, instructionName)
+        baudrate = self.busBaudrate()
+        byteTime = 10.0 / baudrate
+        # the request is already here, but on a real bus it would have taken this long to arrive
+        busTime = len(packet) * byteTime
+
+        # servos with a different baud rate only see garbage
+        reachable = dict((servo.servoId, servo) for servo in self.servos.values() if servo.baudrate() is None or abs(servo.baudrate() - baudrate) < 0.03 * baudrate)
+        if servoId == self.protocol.broadcastId:
+            servos = [reachable[servoIdInList] for servoIdInList in sorted(reachable.keys())]
+        elif servoId in reachable:
+            servos = [reachable[servoId]]
+        else:
+            servos = []
+
+        answers = [] # (servo, answer data)
+        if instructionName == 'PING':
+            answers = [(servo, '') for servo in servos]
+        elif instructionName == 'READ' and len(data) >= 2:
+            answers = [(servo, servo.read(data[0], data[1])) for servo in servos]
+        elif instructionName == 'WRITE' and len(data) >= 1:
+            for servo in servos:
+                servo.write(data[0], data[1:])
+            answers = [(servo, '') for servo in servos]
+        elif instructionName == 'REG_WRITE' and len(data) >= 1:
+            for servo in servos:
+                servo.registeredWrite = (data[0], data[1:])
+            answers = [(servo, '') for servo in servos]
+        elif instructionName == 'ACTION':
+            for servo in servos:
+                if servo.registeredWrite:
+                    servo.write(*servo.registeredWrite)
+                    servo.registeredWrite = None
+        elif instructionName == 'RESET':
+            for servo in servos:
+                # the servo keeps its id and baud rate, so the fleet stays addressable
+                self.servos[servo.servoId] = EmulatedServo(self.protocol, servo.servoId, servo.baudrate() or baudrate, servo.defaultReturnDelayTime)
+            answers = [(servo, '') for servo in servos]
+        elif instructionName == 'SYNC_WRITE' and len(data) >= 2:
+            address, length = data[0], data[1]
+            for position in range(2, len(data) - length, length + 1):
+                if data[position] in reachable:
+                    reachable[data[position]].write(address, data[position + 1:position + 1 + length])
+        elif instructionName == 'SYNC_READ' and len(data) >= 2:
+            # the listed servos answer one after the other
+            for servoIdInList in data[2:]:
+                if servoIdInList in reachable:
+                    answers.append((reachable[servoIdInList], reachable[servoIdInList].read(data[0], data[1])))
+
+        if servoId == self.protocol.broadcastId and instructionName not in ['PING', 'SYNC_READ']:
+            answers = [] # broadcasts are not answered
+        answers = [(servo, answerData) for servo, answerData in answers if servo.answers(instructionName)]
+        self.sendAnswers(answers, busTime, byteTime)
+        self.updateServoIds()
+
+    def updateServoIds(self):
+        # servos which got a new id written answer to it after their answer to the write
+        for servoId, servo in self.servos.items():
+            newServoId = servo.getField('servoId', servoId)
+            if newServoId != servoId:
+                del self.servos[servoId]
+                servo.servoId = newServoId
+                self.servos[newServoId] = servo
+
+    def sendAnswers(self, answers, busTime, byteTime):
+        startTime = time.time()
+        for servo, answerData in answers:
+            answerPacket = self.protocol.makePacket(servo.servoId, 0, answerData)
+            busTime += servo.returnDelay() + len(answerPacket) * byteTime
+            if self.random.random() < self.dropProbability:
+                continue
+            if self.random.random() < self.noiseProbability:
+                answerPacket = bytearray(self.random.randint(0, 255) for _ in range(self.random.randint(1, 8))) + answerPacket
+            delay = startTime + busTime - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            os.write(self.masterFd, str(answerPacket))
+            self.numAnswers += 1
+
+
+if __name__ == '__main__':
+    argumentParser = argparse.ArgumentParser(description='Emulates a bus of servos behind a pseudo terminal')
+    argumentParser.add_argument('--protocol', default='RobotisServo', help='memory layout and instruction set of the servos')
+    argumentParser.add_argument('--servos', type=int, default=10, help='number of servos, with the ids 1 to N (at most 253)')
+    argumentParser.add_argument('--baudrate', type=int, default=1000000, help='initial baud rate of the servos')
+    argumentParser.add_argument('--return-delay', type=int, default=250, help='return delay time register value (2 us steps)')
+    argumentParser.add_argument('--noise', type=float, default=0.0, help='probability of random bytes in front of an answer')
+    argumentParser.add_argument('--drop', type=float, default=0.0, help='probability of an answer getting lost')
+    arguments = argumentParser.parse_args()
+
+    emulator = ServoEmulator(arguments.protocol, range(1, min(arguments.servos, 253) + 1), arguments.baudrate, arguments.return_delay, arguments.noise, arguments.drop)
+    emulator.start()
+    print 'emulating %d %s servos on %s, press ctrl+c to quit' % (len(emulator.servos), arguments.protocol, emulator.portName)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    print '%d requests, %d answers' % (emulator.numRequests, emulator.numAnswers)
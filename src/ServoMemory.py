@@ -0,0 +1,57 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+from common.MonotonicClock import monotonic
+
+class ServoMemory:
+    # shadow copy of the memory of one servo, which knows when each field was read and which fields got written since
+
+    def __init__(self, memoryInfo):
+        self.memoryInfo = memoryInfo
+        self.image = bytearray(memoryInfo['memorySize'])
+        self.fields = [memoryInfo[fieldName] for fieldName in memoryInfo['fieldNames']]
+        self.readTime = [None] * len(self.fields)
+        self.dirty = [False] * len(self.fields)
+
+    def fieldsInRange(self, address, length):
+        return [fieldInfo for fieldInfo in self.fields if fieldInfo['address'] < address + length and fieldInfo['address'] + fieldInfo['size'] > address]
+
+    def update(self, address, data, timestamp=None):
+        data = bytearray(data)
+        self.image[address:address + len(data)] = data
+        timestamp = timestamp or monotonic()
+        for fieldInfo in self.fieldsInRange(address, len(data)):
+            # only fields which were read completely are up to date
+            if fieldInfo['address'] >= address and fieldInfo['address'] + fieldInfo['size'] <= address + len(data):
+                self.readTime[fieldInfo['index']] = timestamp
+                self.dirty[fieldInfo['index']] = False
+
+    def markDirty(self, address, length):
+        for fieldInfo in self.fieldsInRange(address, length):
+            self.dirty[fieldInfo['index']] = True
+
+    def isCached(self, fieldInfo):
+        # volatile fields are changed by the servo itself, so their last read value can't be used
+        index = fieldInfo['index']
+        return self.readTime[index] is not None and not self.dirty[index] and not fieldInfo['volatile']
+
+    def isRangeCached(self, address, length):
+        fields = self.fieldsInRange(address, length)
+        return len(fields) > 0 and all(self.isCached(fieldInfo) for fieldInfo in fields)
+
+    def cachedRanges(self):
+        # (address, length) of all runs of neighbouring cached fields
+        ranges = []
+        for fieldInfo in self.fields:
+            if not self.isCached(fieldInfo):
+                continue
+            if ranges and sum(ranges[-1]) == fieldInfo['address']:
+                ranges[-1] = (ranges[-1][0], ranges[-1][1] + fieldInfo['size'])
+            else:
+                ranges.append((fieldInfo['address'], fieldInfo['size']))
+        return ranges
+
+    def uncachedFieldNames(self):
+        return [fieldInfo['name'] for fieldInfo in self.fields if not self.isCached(fieldInfo)]
+
+    def getData(self, address, length):
+        return self.image[address:address + length]
@@ -1,7 +1,7 @@
 #! /usr/bin/python
 # -*- coding: utf-8 -*-
 
-import sys
+import sys, argparse
 
 from PyQt4.QtGui import QApplication
 
@@ -18,10 +18,17 @@ if __name__ == '__main__':
     except:
         pass
 
+    argumentParser = argparse.ArgumentParser(description='Servo Tool')
+    argumentParser.add_argument('--record', metavar='FILE', help='record the raw bus traffic to a capture file')
+    argumentParser.add_argument('--replay', metavar='FILE', help='replay a capture file instead of using the serial port')
+    argumentParser.add_argument('--replay-speed', type=float, default=1.0, help='speed factor for the replay, 0 replays as fast as possible')
+    arguments, _ = argumentParser.parse_known_args() # the rest is left to qt
+
     app = QApplication(sys.argv)
 
     # setup serial communication thread
     serialThread = SerialThread(app)
+    serialThread.start()
 
     # setup main window
     mainWindow = MainWindow(serialThread, parent=app)
@@ -29,25 +36,47 @@ if __name__ == '__main__':
 
     # connect signals
     serialThread.logMessage.connect(mainWindow.log)
+    serialThread.setLogLevel(mainWindow.spinLogLevel.value())
+    mainWindow.spinLogLevel.valueChanged.connect(serialThread.setLogLevel)
     serialThread.serialConnectionError.connect(mainWindow.serialConnectionError)
     serialThread.servoPing.connect(mainWindow.servoAdd)
-    serialThread.servoData.connect(mainWindow.servoDataUpdate)
+    serialThread.servoDataBatch.connect(mainWindow.servoDataBatchUpdate)
     serialThread.packetSent.connect(mainWindow.packetSent)
     serialThread.packetReceived.connect(mainWindow.packetReceived)
+    serialThread.busStatistics.connect(mainWindow.busStatisticsUpdate)
+    serialThread.baudrateFound.connect(mainWindow.baudrateFound)
+    serialThread.baudrateChanged.connect(mainWindow.baudrateChanged)
+    serialThread.busSpeedOptimized.connect(mainWindow.busSpeedOptimized)
+    serialThread.transactionStatistics.connect(mainWindow.statisticsPanel.statisticsUpdate)
+    mainWindow.statisticsPanel.resetStatistics.connect(serialThread.resetStatistics)
     mainWindow.serialConnectionOpen.connect(serialThread.openSerialPort)
     mainWindow.serialConnectionClose.connect(serialThread.closeSerialPort)
-    mainWindow.serialConnectionStartListening.connect(serialThread.start)
+    mainWindow.serialConnectionStartListening.connect(serialThread.startListening)
     mainWindow.serialConnectionPing.connect(serialThread.pingServos)
     mainWindow.serialConnectionScan.connect(serialThread.scanForServos)
     mainWindow.serialConnectionScanSlow.connect(serialThread.scanForServosSlow)
+    mainWindow.serialConnectionFindBaudrate.connect(serialThread.discoverBaudrates)
+    mainWindow.serialConnectionOptimizeBusSpeed.connect(serialThread.optimizeBusSpeed)
     mainWindow.serialConnectionReadAllData.connect(serialThread.readAllServoData)
+    mainWindow.serialConnectionRefreshData.connect(serialThread.refreshServoData)
     mainWindow.serialConnectionReadData.connect(serialThread.readServoData)
+    mainWindow.serialConnectionSyncReadData.connect(serialThread.syncReadServoData)
     mainWindow.serialConnectionWriteData.connect(serialThread.writeServoData)
     mainWindow.serialConnectionSendData.connect(serialThread.sendData)
     mainWindow.serialConnectionSendCustomPacket.connect(serialThread.sendPacket)
 
+    if arguments.record:
+        serialThread.startRecording(arguments.record)
+    if arguments.replay:
+        serialThread.startReplay(arguments.replay, arguments.replay_speed)
+
     # start main qt thread
     exitCode = app.exec_()
 
+    # wait for the serial thread to finish its queued commands
+    serialThread.closeSerialPort()
+    serialThread.stopRecording()
+    serialThread.stop()
+
     sys.exit(exitCode)
 
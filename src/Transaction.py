@@ -0,0 +1,80 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+import threading
+
+from common.MonotonicClock import monotonic
+
+class Transaction:
+    # a request packet sent to a servo together with the answer(s) it is waiting for
+
+    def __init__(self, servoId, instructionName, data=[], callback=None):
+        self.servoId = servoId
+        self.instructionName = instructionName
+        self.data = list(data)
+        self.address = None
+        self.length = None
+        if instructionName in ['READ', 'WRITE', 'REG_WRITE'] and len(self.data) > 0:
+            self.address = self.data[0]
+            if instructionName == 'READ' and len(self.data) > 1:
+                self.length = self.data[1]
+            else:
+                self.length = len(self.data) - 1
+        self.answers = []
+        self.answerIds = [] # broadcast pings get answers from several servos
+        self.error = None
+        self.sentTime = None
+        self.deadline = None
+        self.completedTime = None
+        self.callbacks = []
+        self.finished = threading.Event()
+        if callback:
+            self.callbacks.append(callback)
+
+    def __repr__(self):
+        return 'Transaction(%d, %s, address=%s, length=%s)' % (self.servoId, self.instructionName, self.address, self.length)
+
+    def sent(self, timeout):
+        self.sentTime = monotonic()
+        self.deadline = self.sentTime + timeout
+
+    def expired(self, now=None):
+        return self.deadline is not None and (now or monotonic()) > self.deadline
+
+    def addAnswer(self, errorCode, packetData, servoId=None):
+        self.answers.append((errorCode, packetData))
+        self.answerIds.append(self.servoId if servoId is None else servoId)
+
+    def complete(self, error=None):
+        if self.isDone():
+            return
+        self.error = error
+        self.completedTime = monotonic()
+        self.finished.set()
+        for callback in self.callbacks:
+            callback(self)
+
+    def addCallback(self, callback):
+        # callbacks get called with the transaction as argument from the serial thread
+        if self.isDone():
+            callback(self)
+        else:
+            self.callbacks.append(callback)
+
+    def isDone(self):
+        return self.finished.is_set()
+
+    def wait(self, timeout=None):
+        # block until the serial thread completed the transaction (don't call this from within the serial thread)
+        self.finished.wait(timeout)
+        return self.isDone()
+
+    def result(self):
+        # the data of the first answer, or None if the transaction failed
+        if self.error or not self.answers:
+            return None
+        return self.answers[0][1]
+
+    def latency(self):
+        if self.sentTime is None or self.completedTime is None:
+            return None
+        return self.completedTime - self.sentTime
@@ -0,0 +1,113 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+import bisect
+from collections import deque
+
+from common.MonotonicClock import monotonic
+
+class TransactionStatistics:
+    # counters and round trip latency histograms of the finished transactions, per servo id and instruction
+    latencyBinEdges = [0.5, 1, 2, 3, 5, 7.5, 10, 15, 20, 30, 50, 100] # [ms] upper edges, the last bin takes the rest
+    rateWindow = 5.0 # [s] the request rate is averaged over this time
+
+    def __init__(self, broadcastId=0xfe):
+        self.broadcastId = broadcastId
+        self.reset()
+
+    def reset(self):
+        self.entries = {}
+        self.discardedBytes = 0
+        self.unmatchedChecksumErrors = 0
+        self.startTime = monotonic()
+        self.changed = True
+
+    def getEntry(self, servoId, instructionName):
+        key = (servoId, instructionName)
+        if key not in self.entries:
+            self.entries[key] = {
+                'servoId': servoId,
+                'instructionName': instructionName,
+                'requests': 0,
+                'answered': 0,
+                'timeouts': 0,
+                'checksumErrors': 0,
+                'otherErrors': 0,
+                'latencySum': 0.0,
+                'latencyMin': None,
+                'latencyMax': None,
+                'latencyHistogram': [0] * (len(self.latencyBinEdges) + 1),
+                'recentRequests': deque(),
+            }
+        return self.entries[key]
+
+    def addTransaction(self, transaction):
+        # used as callback of finished transactions, so it has to be cheap
+        entry = self.getEntry(transaction.servoId, transaction.instructionName)
+        entry['requests'] += 1
+        entry['recentRequests'].append(transaction.sentTime or monotonic())
+        if transaction.error is None:
+            if transaction.answers and transaction.servoId != self.broadcastId:
+                entry['answered'] += 1
+                latency = transaction.latency() * 1000
+                entry['latencySum'] += latency
+                if entry['latencyMin'] is None or latency < entry['latencyMin']:
+                    entry['latencyMin'] = latency
+                if entry['latencyMax'] is None or latency > entry['latencyMax']:
+                    entry['latencyMax'] = latency
+                entry['latencyHistogram'][bisect.bisect_left(self.latencyBinEdges, latency)] += 1
+        elif transaction.error == 'timeout':
+            entry['timeouts'] += 1
+        elif transaction.error == 'checksum error':
+            entry['checksumErrors'] += 1
+        else:
+            entry['otherErrors'] += 1
+        self.changed = True
+
+    def addDiscardedBytes(self, numBytes):
+        self.discardedBytes += numBytes
+        self.changed = True
+
+    def addUnmatchedChecksumError(self):
+        self.unmatchedChecksumErrors += 1
+        self.changed = True
+
+    def latencyPercentile(self, histogram, percent):
+        # upper edge of the histogram bin the percentile falls into, None if it is in the last (open) bin
+        count = sum(histogram)
+        if count == 0:
+            return None
+        limit = count * percent / 100.0
+        total = 0
+        for binIndex, binCount in enumerate(histogram):
+            total += binCount
+            if total >= limit:
+                break
+        if binIndex < len(self.latencyBinEdges):
+            return self.latencyBinEdges[binIndex]
+        return None
+
+    def snapshot(self, now=None):
+        # plain data of all counters, which can be handed to the gui or exported as json
+        now = now or monotonic()
+        entries = []
+        for key in sorted(self.entries.keys()):
+            entry = self.entries[key]
+            recentRequests = entry['recentRequests']
+            while recentRequests and recentRequests[0] < now - self.rateWindow:
+                recentRequests.popleft()
+            result = dict((name, value) for name, value in entry.items() if name != 'recentRequests')
+            result['latencyHistogram'] = list(entry['latencyHistogram'])
+            result['requestRate'] = len(recentRequests) / min(self.rateWindow, max(now - self.startTime, 1e-3))
+            result['latencyMean'] = entry['latencySum'] / entry['answered'] if entry['answered'] else None
+            result['latencyP50'] = self.latencyPercentile(entry['latencyHistogram'], 50)
+            result['latencyP95'] = self.latencyPercentile(entry['latencyHistogram'], 95)
+            entries.append(result)
+        self.changed = False
+        return {
+            'duration': now - self.startTime,
+            'discardedBytes': self.discardedBytes,
+            'unmatchedChecksumErrors': self.unmatchedChecksumErrors,
+            'latencyBinEdges': list(self.latencyBinEdges),
+            'entries': entries,
+        }
+
@@ -38,6 +38,12 @@ class DataConverter:
         'double' : 'd',
     }
 
+    # fixed point types are stored as integers and scaled by these factors
+    fixedPointScale = {
+        'fxp32_t' : 1.0 / (1 << 16), # Q16.16
+        'fxp16_t' : 1.0 / (1 << 6), # Q10.6
+    }
+
     def __init__(self, bigEndian=True, encoding='none'):
         self.setBigEndian(bigEndian)
 
@@ -84,10 +90,8 @@ class DataConverter:
             result = struct.unpack_from(self.endianCharacter + self.formatCharacter.get(typeName, 'i'), binString)[0]
         except:
             return None
-        if typeName == 'fxp32_t':
-            result = float(result) / (1 << 16)
-        elif typeName == 'fxp16_t':
-            result = float(result) / (1 << 6)
+        if typeName in self.fixedPointScale:
+            result = result * self.fixedPointScale[typeName]
         return result
 
     def toString(self, value, typeName=None, encode=False):
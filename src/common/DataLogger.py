@@ -1,41 +1,77 @@
-import sys, os
-from PyQt4.QtCore import QObject, pyqtSlot as Slot
+import sys, os, time, pprint, threading, traceback, ast, Queue
+from numpy import empty, float64, uint16, concatenate, save, load
+from PyQt4.QtCore import QObject, pyqtSignal as Signal, pyqtSlot as Slot
+
+from MonotonicClock import monotonic
+from SessionDirectory import makeSessionDirectory
 
 class DataLogger(QObject):
-    dataKeys = {}
-    dataNames = []
-    dataValues = []
-    dataFormat = '%f '
-    fileName = 'data.log'
-    fileHandle = None
-    logging = False
-    formatString = ''
+    # logs (timestamp, field, value) records into a directory of .npy column chunks plus a header, one directory per
+    # session within filePath/fileName, the files are written by a background thread, so logValue only has to copy
+    # the value into the current chunk
+    logMessage = Signal(int, str)
+    headerFileName = 'header.txt'
+    columns = [('time', float64), ('field', uint16), ('value', float64)]
+    chunkSize = 4096 # records per chunk
+    chunkInterval = 1.0 # [s] a chunk gets written at least this often
+    maxQueuedChunks = 64 # chunks which can wait for the writer thread before new ones are dropped
+    writerTimeout = 5.0 # [s] time the writer thread gets to write the queued chunks when logging is stopped
 
     def __init__(self):
+        QObject.__init__(self)
         self.filePath = os.path.abspath(os.path.realpath(os.path.dirname(sys.argv[0])))
+        self.fileName = 'data'
+        self.dataKeys = {}
+        self.dataNames = []
+        self.logging = False
+        self.writeQueue = None
+        self.writerThread = None
+        self.chunk = None
+        self.chunkLength = 0
+        self.chunkStartTime = 0
+        self.droppedRecords = 0
 
     def addField(self, dataId, dataName):
         if self.logging or self.dataKeys.has_key(dataId):
             return
         self.dataKeys[dataId] = len(self.dataNames)
         self.dataNames.append(dataName)
-        self.dataValues.append(None)
 
     def removeAllFields(self):
         self.toggleLogging(False)
         self.dataKeys = {}
         self.dataNames = []
-        self.dataValues = []
 
-    def logValue(self, dataId, dataValue):
-        # log data to file
+    def newChunk(self):
+        self.chunk = dict((columnName, empty(self.chunkSize, dtype)) for columnName, dtype in self.columns)
+        self.chunkLength = 0
+
+    def logValue(self, dataId, dataValue, timestamp=None):
+        # timestamp is a monotonic time, defaults to now
         if self.logging and self.dataKeys.has_key(dataId):
-            self.dataValues[self.dataKeys[dataId]] = dataValue
-            self.logDataCount += 1
-            # after receiving a complete data set, write it into the file
-            if self.logDataCount == len(self.dataNames):
-                self.fileHandle.write(self.formatString % tuple(self.dataValues))
-                self.logDataCount = 0
+            timestamp = timestamp or monotonic()
+            if self.chunkLength == 0:
+                self.chunkStartTime = timestamp
+            self.chunk['time'][self.chunkLength] = timestamp
+            self.chunk['field'][self.chunkLength] = self.dataKeys[dataId]
+            self.chunk['value'][self.chunkLength] = dataValue
+            self.chunkLength += 1
+            if self.chunkLength == self.chunkSize or timestamp - self.chunkStartTime > self.chunkInterval:
+                self.queueChunk()
+
+    def queueChunk(self):
+        if self.chunkLength == 0:
+            return
+        if not self.writerThread.is_alive():
+            self.logMessage.emit(0, 'Data logging stopped: %s' % self.writerThread.error)
+            self.logging = False
+            return
+        chunk = dict((columnName, column[:self.chunkLength]) for columnName, column in self.chunk.items())
+        try:
+            self.writeQueue.put_nowait(chunk)
+        except Queue.Full: # the disk can't keep up, rather lose data than block the data path
+            self.droppedRecords += self.chunkLength
+        self.newChunk()
 
     @Slot(str)
     def changeLogFileName(self, fileName):
@@ -44,12 +80,110 @@ class DataLogger(QObject):
     @Slot(bool)
     def toggleLogging(self, enabled):
         if enabled:
-            self.fileHandle = open(os.path.join(self.filePath, self.fileName), 'a')
-            self.fileHandle.write(('# ' + '%s ' * len(self.dataNames) + '\n') % tuple(self.dataNames))
-            self.formatString = self.dataFormat * len(self.dataNames) + '\n'
-            self.logDataCount = 0
+            if self.logging:
+                return
+            directory = os.path.join(self.filePath, self.fileName)
+            header = {
+                'fieldNames': list(self.dataNames),
+                'columns': [(columnName, dtype.__name__) for columnName, dtype in self.columns],
+                # monotonic timestamps can be converted to wall clock time with these two
+                'startTime': time.time(),
+                'startMonotonic': monotonic(),
+                'numChunks': 0,
+                'numRecords': 0,
+            }
+            self.writeQueue = Queue.Queue(self.maxQueuedChunks)
+            self.writerThread = DataLogWriter(directory, header, self.writeQueue)
+            self.writerThread.start()
+            self.droppedRecords = 0
+            self.newChunk()
             self.logging = True
         else:
+            if not self.logging:
+                return
             self.logging = False
-            if self.fileHandle:
-                self.fileHandle.close()
+            self.queueChunk()
+            try:
+                self.writeQueue.put(None, timeout=self.writerTimeout)
+            except Queue.Full:
+                pass
+            self.writerThread.join(self.writerTimeout)
+            if self.writerThread.is_alive():
+                self.logMessage.emit(0, 'The data log writer did not finish within %.0f seconds' % self.writerTimeout)
+            elif self.writerThread.error:
+                self.logMessage.emit(0, 'Error writing the data log: %s' % self.writerThread.error)
+            else:
+                self.logMessage.emit(1, 'Logged %d records to %s' % (self.writerThread.header['numRecords'], self.writerThread.sessionDirectory))
+            self.writerThread = None
+            self.writeQueue = None
+
+
+class DataLogWriter(threading.Thread):
+    # writes the chunks from the queue, a None in the queue ends the thread
+
+    def __init__(self, directory, header, writeQueue):
+        threading.Thread.__init__(self, name='DataLogWriter')
+        self.daemon = True
+        self.directory = directory
+        self.sessionDirectory = None
+        self.header = header
+        self.writeQueue = writeQueue
+        self.error = None
+
+    def run(self):
+        try:
+            self.writeChunks()
+        except Exception, e:
+            self.error = e
+            traceback.print_exc()
+
+    def writeChunks(self):
+        self.sessionDirectory = makeSessionDirectory(self.directory, 'log')
+        self.writeHeader()
+        while True:
+            chunk = self.writeQueue.get()
+            if chunk is None:
+                break
+            for columnName, _ in DataLogger.columns:
+                save(os.path.join(self.sessionDirectory, chunkFileName(self.header['numChunks'], columnName)), chunk[columnName])
+            self.header['numChunks'] += 1
+            self.header['numRecords'] += len(chunk['time'])
+            self.writeHeader()
+
+    def writeHeader(self):
+        # the header is written last, so it never lists a chunk which is not complete
+        headerFile = open(os.path.join(self.sessionDirectory, DataLogger.headerFileName + '.tmp'), 'w')
+        pprint.pprint(self.header, stream=headerFile, indent=2)
+        headerFile.close()
+        headerFileName = os.path.join(self.sessionDirectory, DataLogger.headerFileName)
+        if os.name == 'nt' and os.path.exists(headerFileName):
+            os.remove(headerFileName) # windows can't rename onto an existing file
+        os.rename(headerFile.name, headerFileName)
+
+
+def chunkFileName(chunkNumber, columnName):
+    return 'chunk%06d.%s.npy' % (chunkNumber, columnName)
+
+
+def loadDataLog(directory):
+    # returns the header and the complete columns of a session directory as numpy arrays,
+    # e.g. log['value'][log['field'] == log['fieldNames'].index(name)]
+    header = ast.literal_eval(open(os.path.join(directory, DataLogger.headerFileName), 'U').read())
+    dataLog = dict(header)
+    for columnName, dtypeName in header['columns']:
+        chunks = [load(os.path.join(directory, chunkFileName(chunkNumber, columnName)), mmap_mode='r') for chunkNumber in range(header['numChunks'])]
+        dataLog[columnName] = concatenate(chunks) if chunks else empty(0, dtypeName)
+    return dataLog
+
+
+def splitFields(dataLog):
+    # {fieldName: (times, values)} of a loaded data log
+    order = dataLog['field'].argsort(kind='mergesort')
+    fields = dataLog['field'][order]
+    boundaries = fields.searchsorted(range(len(dataLog['fieldNames']) + 1))
+    times = dataLog['time'][order]
+    values = dataLog['value'][order]
+    result = {}
+    for fieldIndex, fieldName in enumerate(dataLog['fieldNames']):
+        result[fieldName] = (times[boundaries[fieldIndex]:boundaries[fieldIndex + 1]], values[boundaries[fieldIndex]:boundaries[fieldIndex + 1]])
+    return result
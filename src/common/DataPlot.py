@@ -6,9 +6,14 @@ import sys, math
 from PyQt4.QtGui import QPen, QTextEdit
 from PyQt4.QtCore import QEvent, QPointF, QTimer, Qt, pyqtSignal as Signal, pyqtSlot as Slot
 
+from MonotonicClock import monotonic
+
 try:
     import PyQt4.Qwt5 as Qwt
-    from PyQt4.Qwt5.anynumpy import arange, zeros, concatenate
+    from PyQt4.Qwt5.anynumpy import argsort, empty
+    from RingBuffer import RingBuffer
+    from MinMaxPyramid import MinMaxPyramid
+    from PlotHistory import PlotHistory
 
 except Exception, e:
 
@@ -24,6 +29,12 @@ except Exception, e:
         def setRedrawInterval(self, interval):
             pass
 
+        def enableHistory(self, directory):
+            pass
+
+        def closeHistory(self):
+            pass
+
         def addCurve(self, curveId, curveName):
             pass
 
@@ -33,7 +44,7 @@ except Exception, e:
         def removeCurve(self, curveId):
             pass
 
-        def updateValue(self, curveId, value):
+        def updateValue(self, curveId, value, timestamp=None):
             pass
 
         @Slot(bool)
@@ -54,7 +65,8 @@ else:
         mouseCoordinatesChanged = Signal(QPointF)
         colors = [Qt.red, Qt.blue, Qt.magenta, Qt.cyan, Qt.green]
         dataNumValuesSaved = 1000
-        dataNumValuesPloted = 1000
+        defaultTimeWindow = 10.0 # [s]
+        minTimeWindow = 0.01 # [s]
 
         def __init__(self, *args):
             super(DataPlot, self).__init__(*args)
@@ -63,7 +75,8 @@ else:
 
             self.curves = {}
             self.pauseFlag = False
-            self.dataOffsetX = 0
+            self.timeWindow = self.defaultTimeWindow # [s] width of the x axis
+            self.timeOffset = 0.0 # [s] right border of the x axis before the newest sample
             self.canvasOffsetX = 0
             self.canvasOffsetY = 0
             self.lastCanvasX = 0
@@ -73,9 +86,9 @@ else:
             self.redrawOnFullUpdate = True
             self.redrawTimerInterval = None
             self.redrawManually = False
-            self.oscilloscopeNextDataPosition = 0
             self.oscilloscopeMode = False
             self.lastClickCoordinates = None
+            self.history = None
 
             markerAxisY = Qwt.QwtPlotMarker()
             markerAxisY.setLabelAlignment(Qt.AlignRight | Qt.AlignTop)
@@ -95,10 +108,8 @@ else:
             self.picker.setTrackerPen(QPen(self.colors[-1]))
 
             # Initialize data
-            self.timeAxis = arange(self.dataNumValuesPloted)
             self.canvasDisplayHeight = 1000
             self.canvasDisplayWidth = self.canvas().width()
-            self.dataOffsetX = self.dataNumValuesSaved - len(self.timeAxis)
             self.redraw()
             self.moveCanvas(0, 0)
             self.canvas().setMouseTracking(True)
@@ -136,6 +147,18 @@ else:
                 self.redrawOnFullUpdate = False
                 self.timerRedraw.start(self.redrawTimerInterval)
 
+        def enableHistory(self, directory):
+            # keep all samples in memory mapped files, so panning back is not limited to dataNumValuesSaved samples
+            self.closeHistory()
+            self.history = PlotHistory(directory)
+            for curveId, curve in self.curves.items():
+                self.history.addCurve(curveId, curve['name'])
+
+        def closeHistory(self):
+            if self.history:
+                self.history.close()
+                self.history = None
+
         def resizeEvent(self, event):
             super(DataPlot, self).resizeEvent(event)
             self.rescale()
@@ -151,10 +174,15 @@ else:
             curveObject.attach(self)
             curveObject.setPen(QPen(self.colors[len(self.curves.keys()) % len(self.colors)]))
             self.curves[curveId] = {
+                'id': curveId,
                 'name': curveName,
-                'data': zeros(self.dataNumValuesSaved),
+                'data': RingBuffer(self.dataNumValuesSaved),
+                'times': RingBuffer(self.dataNumValuesSaved),
+                'pyramid': MinMaxPyramid(self.dataNumValuesSaved),
                 'object': curveObject,
             }
+            if self.history:
+                self.history.addCurve(curveId, curveName)
 
         def removeCurve(self, curveId):
             curveId = str(curveId)
@@ -170,18 +198,18 @@ else:
             self.clear()
 
         @Slot(str, float)
-        def updateValue(self, curveId, value):
+        @Slot(str, float, float)
+        def updateValue(self, curveId, value, timestamp=None):
+            # timestamp is the monotonic time the value was measured at, defaults to now
             curveId = str(curveId)
             # update data plot
             if (not self.pauseFlag) and curveId in self.curves:
-                if self.oscilloscopeMode:
-                    self.curves[curveId]['data'][self.oscilloscopeNextDataPosition] = float(value)
-                    # only advance the oscilloscopeNextDataPosition for the first curve in the dict
-                    if self.curves.keys()[0] == curveId:
-                        self.oscilloscopeNextDataPosition = (self.oscilloscopeNextDataPosition + 1) % len(self.timeAxis)
-                else:
-                    self.curves[curveId]['data'] = concatenate((self.curves[curveId]['data'][1:], self.curves[curveId]['data'][:1]), 1)
-                    self.curves[curveId]['data'][-1] = float(value)
+                timestamp = timestamp or monotonic()
+                self.curves[curveId]['times'].append(timestamp)
+                self.curves[curveId]['data'].append(float(value))
+                if self.history:
+                    self.history.append(curveId, timestamp, float(value))
+                self.curves[curveId]['pyramid'].append(float(value))
 
                 if not self.redrawManually:
                     if self.redrawOnEachUpdate or (self.redrawOnFullUpdate and self.curves.keys()[0] == curveId):
@@ -194,14 +222,68 @@ else:
         @Slot(bool)
         def toggleOscilloscopeMode(self, enabled):
             self.oscilloscopeMode = enabled
+            self.rescale()
 
         def hasCurve(self, curveId):
             curveId = str(curveId)
             return curveId in self.curves
 
+        def getTimeRange(self):
+            # (oldest, newest) timestamp of all curves
+            oldest = newest = None
+            for curve in self.curves.values():
+                times = curve['times']
+                if times.numValues == 0:
+                    continue
+                first = times.oldest()
+                historyRange = self.history and self.history.getTimeRange(curve['id'])
+                if historyRange:
+                    first = min(first, historyRange[0])
+                if oldest is None or first < oldest:
+                    oldest = first
+                if newest is None or times.newest() > newest:
+                    newest = times.newest()
+            if newest is None:
+                now = monotonic()
+                return now, now
+            return oldest, newest
+
+        def getCurveData(self, curve, startTime, endTime, maxPoints):
+            # timestamps and values of all samples between startTime and endTime,
+            # or their min/max envelope if there are more than maxPoints samples
+            times = curve['times']
+            if self.history and (times.numValues == 0 or startTime < times.oldest()):
+                historyRange = self.history.getTimeRange(curve['id'])
+                if historyRange and (times.numValues == 0 or historyRange[0] < times.oldest()):
+                    # page older samples in from the history files
+                    return self.history.getCurveData(curve['id'], startTime, endTime, maxPoints)
+            firstIndex = max(times.searchsorted(startTime), len(times) - min(times.numValues, len(times)))
+            length = times.searchsorted(endTime, 'right') - firstIndex
+            if length <= 0:
+                return empty(0), empty(0)
+            indexOffset = times.numValues - len(times) # number of samples dropped from the ring buffers
+            decimated = curve['pyramid'].decimate(indexOffset + firstIndex, length, maxPoints)
+            if decimated:
+                positions, values = decimated
+                return times.take(positions - indexOffset), values
+            return times.window(firstIndex, length), curve['data'].window(firstIndex, length)
+
         def redraw(self):
+            # draw at most two points (min and max) per pixel of the canvas
+            maxPoints = 2 * max(1, self.canvas().width())
+            _, newestTime = self.getTimeRange()
             for curveId in self.curves.keys():
-                self.curves[curveId]['object'].setData(self.timeAxis, self.curves[curveId]['data'][self.dataOffsetX : self.dataOffsetX + len(self.timeAxis)])
+                if self.oscilloscopeMode:
+                    # the x axis wraps around every timeWindow seconds and the newest values overwrite the oldest ones
+                    times, values = self.getCurveData(self.curves[curveId], newestTime - self.timeWindow, newestTime, maxPoints)
+                    positions = times % self.timeWindow
+                    order = argsort(positions, kind='mergesort')
+                    positions, values = positions[order], values[order]
+                else:
+                    endTime = newestTime - self.timeOffset
+                    times, values = self.getCurveData(self.curves[curveId], endTime - self.timeWindow, endTime, maxPoints)
+                    positions = times - endTime
+                self.curves[curveId]['object'].setData(positions, values)
                 #self.curves[curveId]['object'].setStyle(Qwt.QwtPlotCurve.CurveStyle(3))
             self.replot()
 
@@ -218,14 +300,21 @@ else:
 
             self.setAxisScale(Qwt.QwtPlot.yLeft, yLowerLimit, yUpperLimit, yStepSize)
 
-            self.setAxisScale(Qwt.QwtPlot.xBottom, 0, len(self.timeAxis))
+            if self.oscilloscopeMode:
+                self.setAxisScale(Qwt.QwtPlot.xBottom, 0, self.timeWindow)
+            else:
+                self.setAxisScale(Qwt.QwtPlot.xBottom, -self.timeWindow, 0)
             self.redraw()
 
+        def clampTimeOffset(self):
+            oldestTime, newestTime = self.getTimeRange()
+            self.timeOffset = max(0.0, min(self.timeOffset, newestTime - oldestTime - self.timeWindow))
+
         def rescaleAxisX(self, deltaX):
-            newLen = len(self.timeAxis) + deltaX
-            newLen = max(10, min(newLen, self.dataNumValuesSaved))
-            self.timeAxis = arange(newLen)
-            self.dataOffsetX = max(0, min(self.dataOffsetX, self.dataNumValuesSaved - len(self.timeAxis)))
+            oldestTime, newestTime = self.getTimeRange()
+            self.timeWindow += deltaX * self.timeWindow / self.canvas().width()
+            self.timeWindow = max(self.minTimeWindow, min(self.timeWindow, max(self.defaultTimeWindow, newestTime - oldestTime)))
+            self.clampTimeOffset()
             self.rescale()
 
         def scaleAxisY(self, maxValue):
@@ -233,8 +322,8 @@ else:
             self.rescale()
 
         def moveCanvas(self, deltaX, deltaY):
-            self.dataOffsetX += deltaX * len(self.timeAxis) / float(self.canvas().width())
-            self.dataOffsetX = max(0, min(self.dataOffsetX, self.dataNumValuesSaved - len(self.timeAxis)))
+            self.timeOffset -= deltaX * self.timeWindow / self.canvas().width()
+            self.clampTimeOffset()
             self.canvasOffsetX += deltaX * self.canvasDisplayWidth / self.canvas().width()
             self.canvasOffsetY += deltaY * self.canvasDisplayHeight / self.canvas().height()
             self.rescale()
@@ -279,7 +368,7 @@ if __name__ == '__main__':
     plot.addCurve(0, '(x/500)^2')
     plot.addCurve(1, 'sin(x / 20) * 500')
     for i in range(plot.dataNumValuesSaved):
-        plot.updateValue(0, (i / 500.0) * (i / 5.0))
-        plot.updateValue(1, math.sin(i / 20.0) * 500)
+        plot.updateValue(0, (i / 500.0) * (i / 5.0), i * 0.02)
+        plot.updateValue(1, math.sin(i / 20.0) * 500, i * 0.02)
 
     sys.exit(app.exec_())
@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
-from PyQt4.QtGui import QColor
-from PyQt4.QtCore import QObject, pyqtSignal as Signal, pyqtSlot as Slot
+import time, logging, logging.handlers
+from collections import deque
+
+from PyQt4.QtGui import QColor, QTextCursor, QTextCharFormat
+from PyQt4.QtCore import QObject, QTimer, pyqtSignal as Signal, pyqtSlot as Slot
 
 class LogView(QObject):
     logMessage = Signal(int, str)
@@ -31,13 +34,49 @@ class LogView(QObject):
     ]
 
     textColor = darkColors
+    maxRecords = 10000 # number of messages kept in memory
+    maxVisibleLines = 5000 # number of messages kept in the text view
+    flushInterval = 100 # [ms] messages are added to the text view in batches
 
     def __init__(self, parent, textLogView):
         QObject.__init__(self)
         self.logLevel = 4
         self.textLogView = textLogView
+        self.textLogView.document().setMaximumBlockCount(self.maxVisibleLines)
+        self.records = deque(maxlen=self.maxRecords) # (timestamp, level, message)
+        self.pendingRecords = deque(maxlen=self.maxVisibleLines)
+        self.pendingFileRecords = deque()
+        self.logFileHandler = None
+        self.textFormats = []
+        for color in self.textColor:
+            textFormat = QTextCharFormat()
+            textFormat.setForeground(color)
+            self.textFormats.append(textFormat)
         self.logLevelChanged.connect(self.on_logLevelChanged)
         self.logMessage.connect(self.on_appendMessageToLog)
+        self.timerFlush = QTimer(self)
+        self.timerFlush.timeout.connect(self.flush)
+        self.timerFlush.start(self.flushInterval)
+
+    def setLogFile(self, fileName, maxBytes=10 * 1024 * 1024, backupCount=3):
+        # all messages get written to a rotating log file, in the same batches as they are added to the text view
+        if self.logFileHandler:
+            self.flushLogFile()
+            self.logFileHandler.close()
+            self.logFileHandler = None
+        if fileName:
+            self.logFileHandler = logging.handlers.RotatingFileHandler(fileName, maxBytes=maxBytes, backupCount=backupCount)
+            self.logFileHandler.setFormatter(logging.Formatter('%(asctime)s %(levelno)d %(message)s'))
+
+    def writeToLogFile(self, record):
+        timestamp, logLevel, message = record
+        logRecord = logging.LogRecord('ServoTool', logLevel, '', 0, message, None, None)
+        logRecord.created = timestamp
+        self.logFileHandler.emit(logRecord)
+
+    def flushLogFile(self):
+        while self.pendingFileRecords:
+            self.writeToLogFile(self.pendingFileRecords.popleft())
 
     @Slot(int)
     def on_logLevelChanged(self, logLevel):
@@ -46,5 +85,32 @@ class LogView(QObject):
     @Slot(int, str)
     def on_appendMessageToLog(self, logLevel, message):
         if logLevel <= self.logLevel:
-            self.textLogView.setTextColor(self.textColor[logLevel])
-            self.textLogView.append(str(message))
+            record = (time.time(), logLevel, str(message))
+            self.records.append(record)
+            self.pendingRecords.append(record)
+            if self.logFileHandler:
+                self.pendingFileRecords.append(record)
+
+    @Slot()
+    def flush(self):
+        # append all pending messages with one edit block, so the text view gets layouted only once
+        if self.logFileHandler:
+            self.flushLogFile()
+        if not self.pendingRecords:
+            return
+        cursor = QTextCursor(self.textLogView.document())
+        cursor.movePosition(QTextCursor.End)
+        cursor.beginEditBlock()
+        while self.pendingRecords:
+            _, logLevel, message = self.pendingRecords.popleft()
+            if not self.textLogView.document().isEmpty():
+                cursor.insertBlock()
+            cursor.insertText(message, self.textFormats[logLevel % len(self.textFormats)])
+        cursor.endEditBlock()
+        scrollBar = self.textLogView.verticalScrollBar()
+        scrollBar.setValue(scrollBar.maximum())
+
+    def close(self):
+        # write the messages which are still pending, they are the last ones before the tool got closed
+        self.timerFlush.stop()
+        self.setLogFile(None)
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+from numpy import empty, arange
+
+from RingBuffer import RingBuffer
+
+class MinMaxPyramid:
+    # min/max envelopes of a sample stream for blocks of 2, 4, 8, ... samples, updated with every appended sample,
+    # so a long history can be drawn with a few points per pixel without losing spikes
+
+    def __init__(self, size):
+        self.levels = []
+        blockSize = 2
+        while size // blockSize >= 2:
+            self.levels.append({
+                'blockSize': blockSize,
+                'min': RingBuffer(size // blockSize),
+                'max': RingBuffer(size // blockSize),
+                'pending': False, # first half of the next block is stored in low and high
+                'low': 0.0,
+                'high': 0.0,
+            })
+            blockSize *= 2
+
+    def append(self, value):
+        # every level combines two blocks of the level below, so this is O(1) amortized
+        low = high = value
+        for level in self.levels:
+            if not level['pending']:
+                level['low'] = low
+                level['high'] = high
+                level['pending'] = True
+                return
+            level['pending'] = False
+            low = min(low, level['low'])
+            high = max(high, level['high'])
+            level['min'].append(low)
+            level['max'].append(high)
+
+    def clear(self):
+        for level in self.levels:
+            level['min'].clear()
+            level['max'].clear()
+            level['pending'] = False
+
+    def getLevel(self, length, maxPoints):
+        # coarsest level which still gives at least maxPoints / 2 blocks for length samples
+        result = None
+        for level in self.levels:
+            if length // level['blockSize'] < maxPoints // 2:
+                break
+            result = level
+        return result
+
+    def decimate(self, firstSample, length, maxPoints):
+        # returns sample positions and values of the min/max envelope of samples [firstSample, firstSample + length),
+        # counted since the first appended sample, or None if no decimation is needed
+        if length <= maxPoints:
+            return None
+        level = self.getLevel(length, maxPoints)
+        if level is None:
+            return None
+        blockSize = level['blockSize']
+        numBlocks = level['min'].numValues
+        oldestBlock = numBlocks - len(level['min'])
+        firstBlock = max(-(-firstSample // blockSize), oldestBlock)
+        lastBlock = min((firstSample + length) // blockSize, numBlocks)
+        if lastBlock <= firstBlock:
+            return None
+        count = lastBlock - firstBlock
+        positions = empty(2 * count)
+        values = empty(2 * count)
+        blockStarts = arange(firstBlock, lastBlock) * blockSize
+        positions[0::2] = blockStarts
+        positions[1::2] = blockStarts + blockSize // 2
+        values[0::2] = level['min'].window(firstBlock - oldestBlock, count)
+        values[1::2] = level['max'].window(firstBlock - oldestBlock, count)
+        return positions, values
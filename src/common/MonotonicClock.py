@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+# seconds of a clock that never jumps, unlike time.time() when the system time gets adjusted
+import time
+
+try:
+    from time import monotonic # python 3.3+
+except ImportError:
+    try:
+        import ctypes, ctypes.util, os
+
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        CLOCK_MONOTONIC = 1 # linux
+        _librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1', use_errno=True)
+        _clock_gettime = _librt.clock_gettime
+        _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+        def monotonic():
+            t = timespec()
+            if _clock_gettime(CLOCK_MONOTONIC, ctypes.pointer(t)) != 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, os.strerror(errno))
+            return t.tv_sec + t.tv_nsec * 1e-9
+
+        monotonic()
+    except Exception: # no clock_gettime (i.e. windows), fall back to the wall clock
+        monotonic = time.time
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+import os, pprint
+from numpy import memmap, float64, empty, arange, concatenate, minimum, maximum
+
+from SessionDirectory import makeSessionDirectory
+
+class HistoryColumn:
+    # growing file of float64 samples, only the chunk currently being written and the ranges being read are mapped into memory
+    chunkSize = 65536 # samples per mapped chunk
+    itemSize = 8
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        open(self.fileName, 'wb').close()
+        self.length = 0
+        self.chunk = None
+        self.chunkStart = 0
+
+    def __len__(self):
+        return self.length
+
+    def append(self, value):
+        if self.chunk is None or self.length - self.chunkStart == self.chunkSize:
+            self.mapNextChunk()
+        self.chunk[self.length - self.chunkStart] = value
+        self.length += 1
+
+    def mapNextChunk(self):
+        self.chunk = None
+        self.chunkStart = self.length
+        fileHandle = open(self.fileName, 'r+b')
+        fileHandle.truncate((self.chunkStart + self.chunkSize) * self.itemSize)
+        fileHandle.close()
+        self.chunk = memmap(self.fileName, float64, 'r+', offset=self.chunkStart * self.itemSize, shape=(self.chunkSize,))
+
+    def read(self, start, end):
+        # copy of the samples [start, end), the mapping is released again right away
+        start = max(0, start)
+        end = min(end, self.length)
+        if end <= start:
+            return empty(0)
+        mapping = memmap(self.fileName, float64, 'r', offset=start * self.itemSize, shape=(end - start,))
+        data = mapping.copy()
+        del mapping
+        return data
+
+    def searchsorted(self, value, side='left'):
+        # binary search for ascending data like timestamps, which only touches a few pages of the file
+        if self.length == 0:
+            return 0
+        mapping = memmap(self.fileName, float64, 'r', shape=(self.length,))
+        index = int(mapping.searchsorted(value, side))
+        del mapping
+        return index
+
+    def close(self):
+        # cut off the unused part of the last chunk
+        self.chunk = None
+        fileHandle = open(self.fileName, 'r+b')
+        fileHandle.truncate(self.length * self.itemSize)
+        fileHandle.close()
+
+
+class PlotHistory:
+    # disk backed history of all plotted samples, one directory per session with a timestamp and a value column per curve
+    headerFileName = 'curves.txt'
+
+    def __init__(self, directory):
+        self.sessionDirectory = makeSessionDirectory(directory, 'plot')
+        self.curves = {}
+
+    def hasCurve(self, curveId):
+        return curveId in self.curves
+
+    def addCurve(self, curveId, curveName):
+        if curveId in self.curves:
+            return
+        fileName = os.path.join(self.sessionDirectory, 'curve%d' % len(self.curves))
+        self.curves[curveId] = {
+            'name': curveName,
+            'times': HistoryColumn(fileName + '.times'),
+            'values': HistoryColumn(fileName + '.values'),
+            'timeRange': None, # kept up to date on every append, so plotting does not have to read it from the files
+        }
+        self.writeHeader()
+
+    def writeHeader(self):
+        header = {}
+        for curveId, curve in self.curves.items():
+            header[curveId] = {
+                'name': curve['name'],
+                'times': os.path.basename(curve['times'].fileName),
+                'values': os.path.basename(curve['values'].fileName),
+                'length': len(curve['times']),
+            }
+        headerFile = open(os.path.join(self.sessionDirectory, self.headerFileName), 'w')
+        pprint.pprint(header, stream=headerFile, indent=2)
+        headerFile.close()
+
+    def append(self, curveId, timestamp, value):
+        curve = self.curves[curveId]
+        curve['times'].append(timestamp)
+        curve['values'].append(value)
+        if curve['timeRange'] is None:
+            curve['timeRange'] = (timestamp, timestamp)
+        else:
+            curve['timeRange'] = (curve['timeRange'][0], timestamp)
+
+    def getTimeRange(self, curveId):
+        # (oldest, newest) timestamp of a curve, or None if it has no samples
+        return self.curves[curveId]['timeRange']
+
+    def getCurveData(self, curveId, startTime, endTime, maxPoints):
+        # timestamps and values of all samples between startTime and endTime,
+        # or their min/max envelope if there are more than maxPoints samples
+        times = self.curves[curveId]['times']
+        values = self.curves[curveId]['values']
+        first = times.searchsorted(startTime)
+        last = times.searchsorted(endTime, 'right')
+        length = last - first
+        if length <= maxPoints:
+            return times.read(first, last), values.read(first, last)
+
+        # the range is read piece by piece, so a long time span does not need much memory either
+        blockSize = -(-length // max(1, maxPoints // 2))
+        pieceSize = blockSize * max(1, HistoryColumn.chunkSize // blockSize)
+        positionPieces = []
+        valuePieces = []
+        for pieceStart in range(first, last, pieceSize):
+            pieceEnd = min(pieceStart + pieceSize, last)
+            pieceTimes = times.read(pieceStart, pieceEnd)
+            pieceValues = values.read(pieceStart, pieceEnd)
+            blockStarts = arange(0, len(pieceValues), blockSize)
+            positions = empty(2 * len(blockStarts))
+            envelope = empty(2 * len(blockStarts))
+            positions[0::2] = pieceTimes[blockStarts]
+            positions[1::2] = pieceTimes[minimum(blockStarts + blockSize // 2, len(pieceTimes) - 1)]
+            envelope[0::2] = minimum.reduceat(pieceValues, blockStarts)
+            envelope[1::2] = maximum.reduceat(pieceValues, blockStarts)
+            positionPieces.append(positions)
+            valuePieces.append(envelope)
+        return concatenate(positionPieces), concatenate(valuePieces)
+
+    def close(self):
+        for curve in self.curves.values():
+            curve['times'].close()
+            curve['values'].close()
+        self.writeHeader()
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+from numpy import zeros, concatenate, asarray
+
+class RingBuffer:
+    # fixed size sample storage, appending overwrites the oldest sample without moving any data
+
+    def __init__(self, size, dtype=float):
+        self.data = zeros(size, dtype)
+        self.size = size
+        self.index = 0 # position of the next sample
+        self.numValues = 0 # number of samples appended so far
+
+    def __len__(self):
+        return self.size
+
+    def append(self, value):
+        self.data[self.index] = value
+        self.index += 1
+        if self.index == self.size:
+            self.index = 0
+        self.numValues += 1
+
+    def clear(self):
+        self.data[:] = 0
+        self.index = 0
+        self.numValues = 0
+
+    def parts(self, start, length):
+        # samples [start, start + length) counted from the oldest one, as up to two views into the storage
+        start = (self.index + int(start)) % self.size
+        length = min(int(length), self.size)
+        end = start + length
+        if end <= self.size:
+            return [self.data[start:end]]
+        return [self.data[start:], self.data[:end - self.size]]
+
+    def take(self, indices):
+        # samples at the given positions, counted from the oldest one
+        return self.data[(self.index + asarray(indices, int)) % self.size]
+
+    def newest(self):
+        return self.data[self.index - 1]
+
+    def oldest(self):
+        if self.numValues < self.size:
+            return self.data[0]
+        return self.data[self.index]
+
+    def searchsorted(self, value, side='left'):
+        # position of value counted from the oldest sample, for ascending data like timestamps
+        first = self.data[self.index:]
+        second = self.data[:self.index]
+        if len(second) and (value > first[-1] or (side == 'right' and value == first[-1])):
+            return len(first) + second.searchsorted(value, side)
+        return first.searchsorted(value, side)
+
+    def window(self, start, length):
+        # contiguous copy is only made if the window wraps around the end of the storage
+        parts = self.parts(start, length)
+        if len(parts) == 1:
+            return parts[0]
+        return concatenate(parts)
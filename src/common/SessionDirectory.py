@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+# a new directory for every logging session, so no session overwrites the files of an earlier one
+import os, time, errno
+
+def makeSessionDirectory(directory, prefix):
+    # creates directory/prefix-date-time, with a counter appended if a session was started within the same second
+    sessionName = time.strftime(prefix + '-%Y%m%d-%H%M%S')
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+    counter = 1
+    while True:
+        sessionDirectory = os.path.join(directory, sessionName if counter == 1 else '%s-%d' % (sessionName, counter))
+        try:
+            os.mkdir(sessionDirectory) # fails if the directory exists, even if another thread just created it
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+            counter += 1
+        else:
+            return sessionDirectory
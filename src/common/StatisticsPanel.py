@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import json
+
+from PyQt4.QtGui import QDockWidget, QWidget, QVBoxLayout, QHBoxLayout, QTableWidget, QTableWidgetItem, QLabel, QPushButton, QFileDialog
+from PyQt4.QtCore import Qt, pyqtSignal as Signal, pyqtSlot as Slot
+
+class StatisticsPanel(QDockWidget):
+    # live table of the transaction statistics collected by the serial thread
+    resetStatistics = Signal()
+
+    columns = [
+        ('Id', 'servoId', '%d'),
+        ('Instruction', 'instructionName', '%s'),
+        ('Requests', 'requests', '%d'),
+        ('Rate [1/s]', 'requestRate', '%.1f'),
+        ('Timeouts', 'timeouts', '%d'),
+        ('Checksum errors', 'checksumErrors', '%d'),
+        ('Other errors', 'otherErrors', '%d'),
+        ('Mean [ms]', 'latencyMean', '%.2f'),
+        ('Min [ms]', 'latencyMin', '%.2f'),
+        ('50% [ms]', 'latencyP50', '<= %g'),
+        ('95% [ms]', 'latencyP95', '<= %g'),
+        ('Max [ms]', 'latencyMax', '%.2f'),
+    ]
+
+    def __init__(self, parent):
+        QDockWidget.__init__(self, 'Bus statistics', parent)
+        self.setObjectName('dockStatistics') # needed to save the dock state
+        self.snapshot = None
+
+        widget = QWidget(self)
+        layout = QVBoxLayout(widget)
+        self.tableStatistics = QTableWidget(0, len(self.columns), widget)
+        self.tableStatistics.setHorizontalHeaderLabels([column[0] for column in self.columns])
+        self.tableStatistics.verticalHeader().setVisible(False)
+        layout.addWidget(self.tableStatistics)
+        buttonLayout = QHBoxLayout()
+        self.labelSummary = QLabel(widget)
+        buttonLayout.addWidget(self.labelSummary, 1)
+        self.buttonReset = QPushButton('Reset', widget)
+        self.buttonReset.clicked.connect(self.resetStatistics)
+        buttonLayout.addWidget(self.buttonReset)
+        self.buttonExport = QPushButton('Export JSON', widget)
+        self.buttonExport.clicked.connect(self.exportStatistics)
+        buttonLayout.addWidget(self.buttonExport)
+        layout.addLayout(buttonLayout)
+        self.setWidget(widget)
+
+    @Slot(object)
+    def statisticsUpdate(self, snapshot):
+        self.snapshot = snapshot
+        if not self.isVisible():
+            return
+        entries = snapshot['entries']
+        self.tableStatistics.setRowCount(len(entries))
+        for rowNumber, entry in enumerate(entries):
+            for columnNumber, (_, key, formatString) in enumerate(self.columns):
+                value = entry[key]
+                text = formatString % value if value is not None else '-'
+                item = self.tableStatistics.item(rowNumber, columnNumber)
+                if not item:
+                    item = QTableWidgetItem()
+                    item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
+                    self.tableStatistics.setItem(rowNumber, columnNumber, item)
+                item.setText(text)
+        self.labelSummary.setText('%.0f s, %d bytes discarded, %d checksum errors outside of transactions' % (
+            snapshot['duration'], snapshot['discardedBytes'], snapshot['unmatchedChecksumErrors']))
+
+    @Slot()
+    def exportStatistics(self):
+        if self.snapshot is None:
+            return
+        fileName = QFileDialog.getSaveFileName(self, 'Export statistics', 'statistics.json', 'JSON (*.json)')
+        if fileName:
+            statisticsFile = open(str(fileName), 'w')
+            json.dump(self.snapshot, statisticsFile, indent=2, sort_keys=True)
+            statisticsFile.close()